@@ -0,0 +1,437 @@
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+import mcs_utils
+
+# Compression parameter of the t-digest. A digest holds at most
+# TDIGEST_COMPRESSION // 2 + 1 centroids per composite, with the smallest
+# centroids in the tails of the distribution.
+TDIGEST_COMPRESSION = 200
+
+# Number of tracks whose variables are extracted at once when compositing
+TRACK_BATCH_SIZE = 512
+
+# Dimensions over which the composites are taken
+COMPOSITE_DIMS = ('tracks', 'cell')
+
+
+# ------------------------------------------------------------------------------
+# Functions to composite variables in MCS trigger areas in constant memory
+# ------------------------------------------------------------------------------
+def composite_var_in_trigger_area(
+        mcs_trigger_locs: xr.Dataset,
+        data_field: xr.DataArray,
+        times_before_trigger: Optional[np.timedelta64] = None,
+        analysis_time: Optional[Tuple[np.datetime64]] = None,
+        bins: Optional[np.ndarray] = None,
+        quantiles: Sequence[float] = (0.05, 0.25, 0.5, 0.75, 0.95),
+        batch_size: int = TRACK_BATCH_SIZE,
+        ) -> xr.Dataset:
+    """
+    Composite a variable in the trigger areas over all tracks and cells
+    without materializing the full (tracks, cell, radius, time) array.
+
+    The tracks are streamed through `mcs_utils.get_var_in_trigger_area` in
+    batches, and every batch only updates the running statistics of
+    `update_composite_stats`. The memory therefore only depends on the batch
+    size and not on the number of tracks.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations with NaN-padded or ragged trigger areas.
+    data_field : xr.DataArray
+        The data field with dimensions 'time' and 'cell'.
+    times_before_trigger : np.timedelta64, optional
+        The time range before the triggering, see
+        `mcs_utils.get_var_in_trigger_area`.
+    analysis_time : Tuple[np.datetime64], optional
+        The analysis period, see `mcs_utils.get_var_in_trigger_area`.
+    bins : np.ndarray, optional
+        The bin edges of the histograms. If None, no histograms are computed.
+    quantiles : Sequence[float], optional
+        The quantiles estimated from the t-digests.
+        Default is (0.05, 0.25, 0.5, 0.75, 0.95).
+    batch_size : int, optional
+        The number of tracks per batch. Default is TRACK_BATCH_SIZE.
+
+    Returns
+    -------
+    xr.Dataset
+        The composite statistics as returned by `get_composite_stats`.
+    """
+    stats = None
+    for batch in mcs_utils.split_trigger_locs(mcs_trigger_locs, batch_size):
+        stats = update_composite_stats(
+            stats,
+            mcs_utils.get_var_in_trigger_area(
+                batch, data_field,
+                times_before_trigger=times_before_trigger,
+                analysis_time=analysis_time,
+                ),
+            bins=bins,
+            )
+    return get_composite_stats(stats, quantiles)
+
+
+def update_composite_stats(
+        stats: Optional[xr.Dataset],
+        var_in_trigger_area: xr.DataArray,
+        bins: Optional[np.ndarray] = None,
+        compression: int = TDIGEST_COMPRESSION,
+        ) -> xr.Dataset:
+    """
+    Update running composite statistics with a batch of the variable in the
+    trigger areas.
+
+    The composites are taken over the dimensions in COMPOSITE_DIMS, separately
+    for all other dimensions such as 'radius' and 'time'. NaN values are
+    ignored. The state consists of
+    - the count, mean and sum of squared deviations, which are merged with
+      the parallel form of Welford's algorithm,
+    - the minimum and maximum,
+    - a merging t-digest of the distribution,
+    - optionally the counts of fixed histogram bins.
+
+    Parameters
+    ----------
+    stats : xr.Dataset or None
+        The running statistics as returned by a previous call. If None, the
+        statistics are initialized with the batch.
+    var_in_trigger_area : xr.DataArray
+        The batch as returned by `mcs_utils.get_var_in_trigger_area`.
+    bins : np.ndarray, optional
+        The bin edges of the histograms. Only used if `stats` is None.
+    compression : int, optional
+        The t-digest compression. Only used if `stats` is None.
+        Default is TDIGEST_COMPRESSION.
+
+    Returns
+    -------
+    xr.Dataset
+        The updated running statistics.
+    """
+    if stats is not None:
+        bins = stats['bin_edges'].values if 'bin_edges' in stats else None
+        compression = stats.attrs['tdigest_compression']
+    batch_stats = _get_batch_stats(var_in_trigger_area, bins, compression)
+    if stats is None:
+        return batch_stats
+    return merge_composite_stats(stats, batch_stats)
+
+
+def merge_composite_stats(*stats: xr.Dataset) -> xr.Dataset:
+    """
+    Merge running composite statistics of disjoint sets of tracks, e.g. from
+    parallel workers.
+
+    Parameters
+    ----------
+    *stats : xr.Dataset
+        The running statistics as returned by `update_composite_stats`. They
+        need to have the same coordinates, bins and compression.
+
+    Returns
+    -------
+    xr.Dataset
+        The running statistics of the union of all tracks.
+    """
+    merged = stats[0]
+    for other in stats[1:]:
+        merged = _merge_two_stats(merged, other)
+    return merged
+
+
+def get_composite_stats(
+        stats: xr.Dataset,
+        quantiles: Sequence[float] = (0.05, 0.25, 0.5, 0.75, 0.95),
+        ) -> xr.Dataset:
+    """
+    Get the composite statistics from the running statistics.
+
+    Parameters
+    ----------
+    stats : xr.Dataset
+        The running statistics as returned by `update_composite_stats`.
+    quantiles : Sequence[float], optional
+        The quantiles estimated from the t-digests.
+        Default is (0.05, 0.25, 0.5, 0.75, 0.95).
+
+    Returns
+    -------
+    xr.Dataset
+        The variables 'count', 'mean', 'std', 'min', 'max' and 'quantiles'
+        along the dimension 'quantile' and, if bins were given, 'histogram'
+        with the 'bin_edges'.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = stats['m2'] / (stats['count'] - 1)
+    composite = xr.Dataset({
+        'count': stats['count'].astype(np.int64),
+        'mean': stats['mean'],
+        'std': np.sqrt(variance.where(stats['count'] > 1)),
+        'min': stats['min'].where(stats['count'] > 0),
+        'max': stats['max'].where(stats['count'] > 0),
+        'quantiles': _get_tdigest_quantiles(stats, quantiles),
+        })
+    if 'histogram' in stats:
+        composite['histogram'] = stats['histogram']
+        composite['bin_edges'] = stats['bin_edges']
+    return composite
+
+
+def _get_batch_stats(
+        var_in_trigger_area: xr.DataArray,
+        bins: Optional[np.ndarray],
+        compression: int,
+        ) -> xr.Dataset:
+    """
+    Compute the running statistics of a single batch.
+    """
+    composite_dims = [
+        dim for dim in COMPOSITE_DIMS if dim in var_in_trigger_area.dims
+        ]
+    group_dims = [
+        dim for dim in var_in_trigger_area.dims if dim not in composite_dims
+        ]
+    var_in_trigger_area = var_in_trigger_area.transpose(
+        *group_dims, *composite_dims
+        )
+    group_shape = var_in_trigger_area.shape[:len(group_dims)]
+    values = var_in_trigger_area.values.reshape(int(np.prod(group_shape)), -1)
+
+    is_valid = ~np.isnan(values)
+    count = is_valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(is_valid, values, 0).sum(axis=1) / count
+    m2 = np.where(is_valid, (values - mean[:, np.newaxis])**2, 0).sum(axis=1)
+    centroid_mean, centroid_weight = _compress_tdigest(
+        values, is_valid.astype(float), compression
+        )
+
+    stats = {
+        'count': count.astype(float),
+        'mean': mean,
+        'm2': m2,
+        'min': np.where(is_valid, values, np.inf).min(axis=1, initial=np.inf),
+        'max': np.where(is_valid, values, -np.inf).max(
+            axis=1, initial=-np.inf,
+            ),
+        'centroid_mean': centroid_mean,
+        'centroid_weight': centroid_weight,
+        }
+    if bins is not None:
+        stats['histogram'] = _get_histogram(values, is_valid, bins)
+    return _stats_to_dataset(
+        stats, var_in_trigger_area, group_dims, group_shape, bins, compression
+        )
+
+
+def _merge_two_stats(stats: xr.Dataset, other: xr.Dataset) -> xr.Dataset:
+    """
+    Merge two running statistics with the parallel form of Welford's algorithm
+    and by compressing the union of the t-digest centroids.
+    """
+    xr.align(stats, other, join='exact')
+    count = stats['count'] + other['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = other['mean'] - stats['mean']
+        mean = xr.where(
+            other['count'] == 0, stats['mean'],
+            xr.where(
+                stats['count'] == 0, other['mean'],
+                stats['mean'] + delta * other['count'] / count,
+                ),
+            )
+        m2 = stats['m2'] + other['m2'] + xr.where(
+            (stats['count'] > 0) & (other['count'] > 0),
+            delta**2 * stats['count'] * other['count'] / count, 0,
+            )
+
+    centroid_mean = xr.concat(
+        [stats['centroid_mean'], other['centroid_mean']], dim='centroid'
+        )
+    centroid_weight = xr.concat(
+        [stats['centroid_weight'], other['centroid_weight']], dim='centroid'
+        )
+    group_shape = centroid_mean.shape[:-1]
+    centroid_mean, centroid_weight = _compress_tdigest(
+        np.nan_to_num(centroid_mean.values).reshape(-1, centroid_mean.shape[-1]),
+        centroid_weight.values.reshape(-1, centroid_weight.shape[-1]),
+        stats.attrs['tdigest_compression'],
+        )
+
+    merged = stats.assign({
+        'count': count,
+        'mean': mean,
+        'm2': m2,
+        'min': np.fmin(stats['min'], other['min']),
+        'max': np.fmax(stats['max'], other['max']),
+        'centroid_mean': (
+            stats['centroid_mean'].dims,
+            centroid_mean.reshape(*group_shape, -1),
+            ),
+        'centroid_weight': (
+            stats['centroid_weight'].dims,
+            centroid_weight.reshape(*group_shape, -1),
+            ),
+        })
+    if 'histogram' in stats:
+        merged['histogram'] = stats['histogram'] + other['histogram']
+    return merged
+
+
+def _compress_tdigest(
+        values: np.ndarray,
+        weights: np.ndarray,
+        compression: int,
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compress weighted values into t-digest centroids, independently for every
+    row.
+
+    The values of each row are sorted and assigned to the centroid
+    floor(k(q)) of the arcsine scale function
+    k(q) = compression / (2 pi) * (arcsin(2q - 1) + pi / 2), where q is the
+    quantile of the value. The centroids are therefore smallest in the tails
+    of the distribution. Values with zero weight are ignored.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values or centroid means with shape (n_rows, n_values).
+    weights : np.ndarray
+        The weights of the values with the same shape.
+    compression : int
+        The t-digest compression.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The centroid means (NaN for empty centroids) and weights with shape
+        (n_rows, compression // 2 + 1), in increasing order of the means.
+    """
+    n_rows = values.shape[0]
+    n_centroids = compression // 2 + 1
+    values = np.where(weights > 0, values, np.inf)
+    order = np.argsort(values, axis=1, kind='stable')
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    values[weights == 0] = 0
+
+    cumulative_weight = np.cumsum(weights, axis=1)
+    total_weight = cumulative_weight[:, -1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        q = (cumulative_weight - weights / 2) / total_weight
+    q = np.clip(np.nan_to_num(q), 0, 1)
+    k = compression / (2*np.pi) * (np.arcsin(2*q - 1) + np.pi/2)
+    centroid = np.minimum(k.astype(np.int64), n_centroids - 1)
+
+    flat_centroid = (
+        np.arange(n_rows)[:, np.newaxis] * n_centroids + centroid
+        ).ravel()
+    centroid_weight = np.bincount(
+        flat_centroid, weights.ravel(), minlength=n_rows * n_centroids
+        ).reshape(n_rows, n_centroids)
+    centroid_sum = np.bincount(
+        flat_centroid, (weights * values).ravel(),
+        minlength=n_rows * n_centroids,
+        ).reshape(n_rows, n_centroids)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid_mean = centroid_sum / centroid_weight
+    return centroid_mean, centroid_weight
+
+
+def _get_tdigest_quantiles(
+        stats: xr.Dataset,
+        quantiles: Sequence[float],
+        ) -> xr.DataArray:
+    """
+    Estimate quantiles from the t-digests by linear interpolation between the
+    centroid means, which are placed at the centers of their cumulative
+    weight. The minimum and maximum bound the interpolation.
+    """
+    centroid_mean = stats['centroid_mean'].transpose(..., 'centroid')
+    centroid_weight = stats['centroid_weight'].transpose(..., 'centroid')
+    group_shape = centroid_mean.shape[:-1]
+    means = centroid_mean.values.reshape(-1, centroid_mean.shape[-1])
+    weights = centroid_weight.values.reshape(-1, centroid_weight.shape[-1])
+    minimum = stats['min'].transpose(*centroid_mean.dims[:-1]).values.ravel()
+    maximum = stats['max'].transpose(*centroid_mean.dims[:-1]).values.ravel()
+
+    quantiles = np.asarray(quantiles, dtype=float)
+    result = np.full((means.shape[0], quantiles.size), np.nan)
+    for i in range(means.shape[0]):
+        is_used = weights[i] > 0
+        if not np.any(is_used):
+            continue
+        weight = weights[i, is_used]
+        total_weight = weight.sum()
+        position = np.concatenate(
+            [[0], np.cumsum(weight) - weight / 2, [total_weight]]
+            )
+        mean = np.concatenate([[minimum[i]], means[i, is_used], [maximum[i]]])
+        result[i] = np.interp(quantiles * total_weight, position, mean)
+
+    return xr.DataArray(
+        result.reshape(*group_shape, quantiles.size),
+        dims=[*centroid_mean.dims[:-1], 'quantile'],
+        coords={
+            **{dim: centroid_mean[dim] for dim in centroid_mean.dims[:-1]
+               if dim in centroid_mean.coords},
+            'quantile': quantiles,
+            },
+        )
+
+
+def _get_histogram(
+        values: np.ndarray,
+        is_valid: np.ndarray,
+        bins: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Count the valid values of every row in the bins. As in np.histogram, the
+    last bin includes its right edge and values outside the bins are ignored.
+    """
+    n_rows, n_bins = values.shape[0], bins.size - 1
+    i_bin = np.searchsorted(bins, np.where(is_valid, values, np.nan),
+                            side='right') - 1
+    i_bin[values == bins[-1]] = n_bins - 1
+    is_in_bins = is_valid & (i_bin >= 0) & (i_bin < n_bins)
+    flat_bin = (np.arange(n_rows)[:, np.newaxis] * n_bins + i_bin)[is_in_bins]
+    return np.bincount(flat_bin, minlength=n_rows * n_bins)\
+        .reshape(n_rows, n_bins)
+
+
+def _stats_to_dataset(
+        stats: dict,
+        var_in_trigger_area: xr.DataArray,
+        group_dims: list,
+        group_shape: tuple,
+        bins: Optional[np.ndarray],
+        compression: int,
+        ) -> xr.Dataset:
+    """
+    Reshape the flat statistics to the composite dimensions and store them in
+    a Dataset.
+    """
+    coords = {
+        dim: var_in_trigger_area[dim] for dim in group_dims
+        if dim in var_in_trigger_area.coords
+        }
+    data_vars = {}
+    for name, value in stats.items():
+        dims = list(group_dims)
+        if name.startswith('centroid'):
+            dims.append('centroid')
+        elif name == 'histogram':
+            dims.append('bin')
+        data_vars[name] = (dims, value.reshape(*group_shape, *value.shape[1:]))
+
+    dataset = xr.Dataset(data_vars, coords=coords)
+    if bins is not None:
+        dataset['bin_edges'] = ('bin_edge', np.asarray(bins, dtype=float))
+    dataset.attrs['tdigest_compression'] = compression
+    return dataset
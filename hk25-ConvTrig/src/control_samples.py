@@ -0,0 +1,390 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+import xarray as xr
+import healpy as hp
+import easygems.healpix as egh
+
+import mcs_utils
+from hp_cache import get_geometry, get_permutation_index
+
+# Number of disc offsets of different rings kept in memory
+DISC_OFFSET_CACHE_SIZE = 256
+
+
+# ------------------------------------------------------------------------------
+# Functions to draw random control samples for MCS trigger composites
+# ------------------------------------------------------------------------------
+def draw_control_trigger_idxs(
+        mcs_trigger_locs: xr.Dataset,
+        RADII: np.ndarray,
+        hp_grid: xr.Dataset,
+        ocean_mask: xr.DataArray,
+        n_samples: int = 1,
+        lat_tolerance: float = 0.,
+        seed: Optional[int] = None,
+        ) -> xr.DataArray:
+    """
+    Draw random control locations for the MCS trigger locations.
+
+    Every control location is matched to a trigger in latitude and, as it
+    keeps the start time of the trigger, in time. It is drawn uniformly from
+    the cells within `lat_tolerance` of the latitude of the trigger cell whose
+    trigger area of the largest radius lies entirely over the ocean and within
+    the ocean mask. As HEALPix cells have equal areas, the control locations
+    are uniformly distributed in area.
+
+    Within the equatorial belt of the HEALPix grid, all rings have the same
+    number of cells and the discs around the cells of a ring are rotations of
+    each other. The disc of each ring is therefore only queried once and the
+    discs of all candidate cells follow from its offsets.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations including 'trigger_idx'.
+    RADII : np.ndarray
+        The radii of the trigger areas in degrees.
+    hp_grid : xr.Dataset
+        The Healpix grid, used to determine nside and the nesting scheme.
+    ocean_mask : xr.DataArray
+        The ocean mask with a 'cell' dimension, which is NaN over land.
+    n_samples : int, optional
+        The number of control samples. Default is 1.
+    lat_tolerance : float, optional
+        The maximum latitude difference in degrees between the rings of a
+        trigger and its control locations. Default is 0, i.e. the same ring.
+    seed : int, optional
+        The seed of the random number generator.
+
+    Returns
+    -------
+    xr.DataArray
+        The Healpix cell indices of the control locations with dimensions
+        ('sample', 'tracks'). Tracks without any candidate cell get -1.
+    """
+    nside = egh.get_nside(hp_grid)
+    nest = True if egh.get_nest(hp_grid) else False
+    radius = np.radians(np.max(RADII))
+    rng = np.random.default_rng(seed)
+
+    is_ocean = _get_dense_ocean_mask(ocean_mask, nside)
+    trigger_ring = _get_ring(
+        nside, _to_ring(nside, nest, mcs_trigger_locs['trigger_idx'].values)
+        )
+    ring_lat = _get_ring_lat(nside)
+
+    control_idxs = np.full(
+        (n_samples, trigger_ring.size), -1, dtype=np.int64
+        )
+    ring_candidates = {}
+    for ring in np.unique(trigger_ring):
+        matched_rings = np.flatnonzero(
+            np.abs(ring_lat - ring_lat[ring]) <= lat_tolerance
+            )
+        for matched_ring in matched_rings:
+            if matched_ring not in ring_candidates:
+                ring_candidates[matched_ring] = _get_ocean_candidates(
+                    nside, nest, matched_ring, radius, is_ocean
+                    )
+        candidates = np.concatenate(
+            [ring_candidates[matched_ring] for matched_ring in matched_rings]
+            )
+        if candidates.size == 0:
+            continue
+        is_ring = trigger_ring == ring
+        control_idxs[:, is_ring] = candidates[
+            rng.integers(0, candidates.size, (n_samples, is_ring.sum()))
+            ]
+
+    return xr.DataArray(
+        control_idxs, dims=['sample', 'tracks'],
+        coords={'tracks': mcs_trigger_locs['tracks']},
+        name='control_trigger_idx',
+        )
+
+
+def get_control_trigger_locs(
+        mcs_trigger_locs: xr.Dataset,
+        control_trigger_idxs: xr.DataArray,
+        RADII: np.ndarray,
+        hp_grid: xr.Dataset,
+        ragged: bool = True,
+        ) -> xr.Dataset:
+    """
+    Get the trigger locations and circular trigger areas of one control
+    sample, which can be passed to `mcs_utils.get_var_in_trigger_area` like
+    the MCS trigger locations.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations the control sample was drawn for.
+    control_trigger_idxs : xr.DataArray
+        The Healpix cell indices of one control sample with dimension
+        'tracks', e.g. `draw_control_trigger_idxs(...).isel(sample=0)`.
+    RADII : np.ndarray
+        The radii of the trigger areas in degrees.
+    hp_grid : xr.Dataset
+        The Healpix grid, used to determine nside and the nesting scheme.
+    ragged : bool, optional
+        If True, store the trigger areas in the ragged layout of
+        `mcs_utils.build_trigger_areas`, otherwise as NaN-padded
+        'trigger_area_idxs'. Default is True.
+
+    Returns
+    -------
+    xr.Dataset
+        The control trigger locations with the start times of the MCS
+        trigger locations. Tracks without a control location are dropped.
+    """
+    nside = egh.get_nside(hp_grid)
+    nest = True if egh.get_nest(hp_grid) else False
+
+    is_valid = (control_trigger_idxs >= 0).values
+    trigger_idx = control_trigger_idxs.values[is_valid]
+    control_trigger_locs = mcs_trigger_locs[['start_basetime']]\
+        .isel(tracks=is_valid)
+    control_trigger_locs = control_trigger_locs.assign(
+        trigger_idx=('tracks', trigger_idx),
+        start_lat=('tracks', get_geometry(nside, 'lat', nest)[trigger_idx]),
+        start_lon=('tracks', get_geometry(nside, 'lon', nest)[trigger_idx]),
+        )
+
+    trigger_areas = build_trigger_areas_from_offsets(
+        nside, nest, trigger_idx, RADII
+        )
+    control_trigger_locs = control_trigger_locs.assign(
+        trigger_areas.assign_coords(tracks=control_trigger_locs['tracks'])
+        )
+    if ragged:
+        return control_trigger_locs
+    return mcs_utils.trigger_areas_to_dense(control_trigger_locs)
+
+
+def build_trigger_areas_from_offsets(
+        nside: int,
+        nest: bool,
+        trigger_idxs: np.ndarray,
+        radii: np.ndarray,
+        ) -> xr.Dataset:
+    """
+    Build the circular trigger areas of many trigger locations in the ragged
+    layout of `mcs_utils.build_trigger_areas` from precomputed disc offsets.
+
+    The disc is only queried once per ring of the equatorial belt. Trigger
+    locations whose disc reaches beyond the belt fall back to
+    `mcs_utils.build_trigger_areas`.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter for the HEALPix map.
+    nest : bool
+        If True, use nested indexing. If False, use ring indexing.
+    trigger_idxs : np.ndarray
+        The Healpix cell indices of the trigger locations.
+    radii : np.ndarray
+        The radii of the trigger areas in degrees.
+
+    Returns
+    -------
+    xr.Dataset
+        The trigger areas as returned by `mcs_utils.build_trigger_areas`.
+    """
+    trigger_idxs = np.asarray(trigger_idxs).astype(np.int64)
+    radii = np.asarray(radii, dtype=float)
+    ring_idxs = _to_ring(nside, nest, trigger_idxs)
+    trigger_ring = _get_ring(nside, ring_idxs)
+
+    n_tracks = trigger_idxs.size
+    n_cells = np.zeros(n_tracks, dtype=np.int64)
+    count = np.zeros((n_tracks, radii.size), dtype=np.int64)
+    blocks = []
+    for ring in np.unique(trigger_ring):
+        tracks = np.flatnonzero(trigger_ring == ring)
+        offsets = _get_disc_offsets(
+            nside, int(ring), np.radians(radii.max()), tuple(radii)
+            )
+        if offsets is None:
+            trigger_areas = mcs_utils.build_trigger_areas(
+                nside, nest, trigger_idxs[tracks], radii
+                )
+            block_count = trigger_areas['trigger_area_count'].values
+            cells = np.split(
+                trigger_areas['trigger_area_cells'].values,
+                np.cumsum(block_count[:, radii.argmax()])[:-1],
+                )
+        else:
+            member_ring, member_pixel, ring_count = offsets
+            cells = _rotate_disc(
+                nside, nest, member_ring, member_pixel,
+                ring_idxs[tracks] - _get_ring_info(nside)[0][ring],
+                )
+            block_count = np.broadcast_to(ring_count, (tracks.size, radii.size))
+        count[tracks] = block_count
+        n_cells[tracks] = block_count[:, radii.argmax()]
+        blocks.append((tracks, cells))
+
+    start = (np.cumsum(n_cells) - n_cells).astype(np.int64)
+    all_cells = np.empty(n_cells.sum(), dtype=np.int64)
+    for tracks, cells in blocks:
+        if isinstance(cells, np.ndarray):
+            all_cells[
+                start[tracks, np.newaxis] + np.arange(cells.shape[1])
+                ] = cells
+            continue
+        for track, track_cells in zip(tracks, cells):
+            all_cells[start[track]:start[track] + track_cells.size] = \
+                track_cells
+
+    trigger_areas = xr.Dataset(
+        data_vars={
+            'trigger_area_start': ('tracks', start),
+            'trigger_area_count': (('tracks', 'radius'), count),
+            'trigger_area_cells': ('trigger_area_cell', all_cells),
+            },
+        coords={'radius': radii},
+        )
+    trigger_areas['radius'].attrs['units'] = 'degree'
+    return trigger_areas
+
+
+def _get_ocean_candidates(
+        nside: int,
+        nest: bool,
+        ring: int,
+        radius: float,
+        is_ocean: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Get the cells of a ring whose disc of the given radius in radians lies
+    entirely over the ocean.
+    """
+    startpix, ringpix = _get_ring_info(nside)
+    ring_cells = startpix[ring] + np.arange(ringpix[ring])
+    offsets = _get_disc_offsets(nside, int(ring), radius, (np.degrees(radius),))
+    if offsets is None:
+        trigger_areas = mcs_utils.build_trigger_areas(
+            nside, False, ring_cells, np.array([np.degrees(radius)])
+            )
+        n_cells = trigger_areas['trigger_area_count'].values[:, 0]
+        is_cell_ocean = is_ocean[
+            _from_ring(nside, nest, trigger_areas['trigger_area_cells'].values)
+            ]
+        n_land = np.add.reduceat(~is_cell_ocean, np.cumsum(n_cells) - n_cells)
+        is_candidate = n_land == 0
+    else:
+        member_ring, member_pixel, _ = offsets
+        cells = _rotate_disc(
+            nside, nest, member_ring, member_pixel, np.arange(ringpix[ring])
+            )
+        is_candidate = is_ocean[cells].all(axis=1)
+    candidates = ring_cells[is_candidate]
+    return _from_ring(nside, nest, candidates)
+
+
+@lru_cache(maxsize=DISC_OFFSET_CACHE_SIZE)
+def _get_disc_offsets(
+        nside: int,
+        ring: int,
+        radius: float,
+        radii: tuple,
+        ) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Get the cells of the disc around the first cell of a ring as offsets in
+    ring and in position within the ring, sorted by the distance to the
+    center, and the number of cells within each radius in degrees.
+
+    Returns None if the disc is not within the equatorial belt, where all
+    rings have 4 * nside cells and the discs of a ring are rotations of each
+    other.
+    """
+    startpix, ringpix = _get_ring_info(nside)
+    vec = get_geometry(nside, 'vec', nest=False)
+    center = startpix[ring]
+    cells = hp.query_disc(nside, vec[center], radius, inclusive=False)
+    member_ring = _get_ring(nside, cells)
+    if np.any(ringpix[member_ring] != 4 * nside) or \
+            ringpix[ring] != 4 * nside:
+        return None
+
+    cos_distance = vec[cells] @ vec[center]
+    order = np.argsort(-cos_distance, kind='stable')
+    cells, cos_distance = cells[order], cos_distance[order]
+    member_ring = member_ring[order]
+    count = np.array([
+        np.sum(cos_distance >= np.cos(np.radians(r))) for r in radii
+        ])
+    count[np.asarray(radii) == max(radii)] = cells.size
+    return member_ring, cells - startpix[member_ring], count
+
+
+def _rotate_disc(
+        nside: int,
+        nest: bool,
+        member_ring: np.ndarray,
+        member_pixel: np.ndarray,
+        position: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Rotate the disc offsets to the given positions within the ring. Returns
+    the cell indices with shape (n_positions, n_disc_cells).
+    """
+    startpix = _get_ring_info(nside)[0]
+    cells = startpix[member_ring] + \
+        (member_pixel + position[:, np.newaxis]) % (4 * nside)
+    return _from_ring(nside, nest, cells)
+
+
+@lru_cache(maxsize=None)
+def _get_ring_info(nside: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the first ring index and the number of cells of all rings, with the
+    rings counted from 0 at the north pole.
+    """
+    startpix, ringpix = hp.ringinfo(nside, np.arange(1, 4 * nside))[:2]
+    return startpix.astype(np.int64), ringpix.astype(np.int64)
+
+
+@lru_cache(maxsize=None)
+def _get_ring_lat(nside: int) -> np.ndarray:
+    """
+    Get the latitude in degrees of all rings.
+    """
+    costheta = hp.ringinfo(nside, np.arange(1, 4 * nside))[2]
+    return np.degrees(np.arcsin(costheta))
+
+
+def _get_ring(nside: int, ring_idxs: np.ndarray) -> np.ndarray:
+    """
+    Get the ring of cells given by their ring index.
+    """
+    return np.searchsorted(_get_ring_info(nside)[0], ring_idxs, side='right') - 1
+
+
+def _to_ring(nside: int, nest: bool, cells: np.ndarray) -> np.ndarray:
+    if not nest:
+        return cells
+    return get_permutation_index(nside, 'ring2nest')[cells]
+
+
+def _from_ring(nside: int, nest: bool, cells: np.ndarray) -> np.ndarray:
+    if not nest:
+        return cells
+    return get_permutation_index(nside, 'nest2ring')[cells]
+
+
+def _get_dense_ocean_mask(ocean_mask: xr.DataArray, nside: int) -> np.ndarray:
+    """
+    Get a boolean ocean mask of the full nested grid. Cells outside a regional
+    ocean mask are treated as land.
+    """
+    is_ocean = ocean_mask.notnull()
+    is_ocean = is_ocean.all([dim for dim in is_ocean.dims if dim != 'cell'])
+    if 'cell' not in is_ocean.indexes:
+        return is_ocean.values
+    dense_is_ocean = np.zeros(hp.nside2npix(nside), dtype=bool)
+    dense_is_ocean[is_ocean['cell'].values] = is_ocean.values
+    return dense_is_ocean
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 import xarray as xr
 import numpy as np
@@ -5,6 +6,10 @@ import healpix as hp
 import easygems.healpix as egh
 
 from constants import EARTH_RADIUS
+from hp_cache import (
+    get_geometry, get_neighbour_table, get_nn_lonlat_index,
+    get_permutation_index, get_stencil_weights,
+    )
 
 # ------------------------------------------------------------------------------
 # Basic HEALPix functionality
@@ -32,6 +37,56 @@ def _extract_hp_params(var: xr.DataArray) -> tuple[int, np.ndarray]:
     return nside, ring_index
 
 
+def attach_coords(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Attaches the latitude and longitude of each HEALPix cell as coordinates.
+
+    This is equivalent to `easygems.healpix.attach_coords`, but reads the
+    coordinates from the geometry store of `hp_cache` instead of computing
+    them on every call. Datasets without a HEALPix coordinate reference
+    system are passed on to `easygems.healpix.attach_coords`, which guesses it.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The input dataset on a HEALPix grid. It can be the full globe or a
+        regional subset of cells given by its 'cell' coordinate.
+
+    Returns
+    -------
+    xr.Dataset
+        The input dataset with 'lat' and 'lon' coordinates along 'cell'.
+    """
+    try:
+        ds.cf["grid_mapping"]
+    except (KeyError, AttributeError):
+        return egh.attach_coords(ds)
+
+    nside = egh.get_nside(ds)
+    nest = True if egh.get_nest(ds) else False
+    if 'cell' in ds.coords:
+        cells = ds['cell'].values.astype(np.int64)
+        lat = get_geometry(nside, "lat", nest)[cells]
+        lon = get_geometry(nside, "lon", nest)[cells]
+    else:
+        cells = np.arange(ds.sizes['cell'], dtype=np.int64)
+        lat = get_geometry(nside, "lat", nest)
+        lon = get_geometry(nside, "lon", nest)
+    return ds.assign_coords(
+        cell=(
+            ("cell",), cells, {"standard_name": "healpix_index"},
+            ),
+        lat=(
+            ("cell",), lat,
+            {"units": "degree_north", "standard_name": "latitude", "axis": "Y"},
+            ),
+        lon=(
+            ("cell",), lon,
+            {"units": "degree_east", "standard_name": "longitude", "axis": "X"},
+            ),
+        )
+
+
 def _nest2ring_index(var: xr.DataArray, nside: int) -> np.ndarray:
     """
     Convert nested indices to ring indices for a given variable.
@@ -49,7 +104,7 @@ def _nest2ring_index(var: xr.DataArray, nside: int) -> np.ndarray:
     numpy.ndarray
         An array of ring indices corresponding to the nested indices.
     """
-    return np.array([hp.ring2nest(nside, i) for i in var.cell.values])
+    return get_permutation_index(nside, "nest2ring")[var.cell.values]
 
 
 def _ring2nest_index(var: xr.DataArray, nside: int) -> np.ndarray:
@@ -69,7 +124,7 @@ def _ring2nest_index(var: xr.DataArray, nside: int) -> np.ndarray:
     numpy.ndarray
         An array of nested indices corresponding to the ring indices.
     """
-    return np.array([hp.nest2ring(nside, i) for i in np.arange(len(var))])
+    return get_permutation_index(nside, "ring2nest")[:len(var)]
 
 
 # ------------------------------------------------------------------------------
@@ -80,6 +135,7 @@ def remap_nn_hp2latlon(
         lats: tuple[int, int, int],
         lons: tuple[int, int, int],
         supersampling: dict={"lon": 1, "lat": 1},
+        cache_on_disk: bool=False,
         ) -> xr.DataArray:
     """
     Remap a HEALPix grid to a regular or rectilinear latitude-longitude grid
@@ -98,17 +154,23 @@ def remap_nn_hp2latlon(
     supersampling : dict, optional
         A dictionary specifying the supersampling factors for longitude and
         latitude. Default is {"lon": 1, "lat": 1}.
+    cache_on_disk : bool, optional
+        If True, the remapping index is also stored in the disk cache of
+        `hp_cache` so that other processes can reuse it. Default is False.
 
     Returns
     -------
     xr.DataArray
         The remapped data array on a regular or rectilinear latitude-longitude
         grid.
+
+    Notes
+    -----
+    The remapping index is cached in memory (see `hp_cache.get_nn_lonlat_index`)
+    so that repeated remappings of the same grid only gather and coarsen.
     """
     idx = _get_nn_lon_lat_index(
-        egh.get_nside(var_hp),
-        np.linspace(lons[0], lons[1], lons[2]*supersampling['lon']),
-        np.linspace(lats[0], lats[1], lats[2]*supersampling['lat'])
+        egh.get_nside(var_hp), lats, lons, supersampling, cache_on_disk
     )
     return var_hp.drop(['lat', 'lon']).isel(cell=idx).coarsen(
         supersampling).mean(skipna=False)
@@ -116,21 +178,28 @@ def remap_nn_hp2latlon(
 
 def _get_nn_lon_lat_index(
         nside: int,
-        lons: np.ndarray,
-        lats: np.ndarray
+        lats: tuple[int, int, int],
+        lons: tuple[int, int, int],
+        supersampling: dict={"lon": 1, "lat": 1},
+        cache_on_disk: bool=False,
         ) -> xr.DataArray:
     """
-    Calculate the nearest neighbor HEALPix index for a set of longitudes and
-    latitudes and a given nside.
+    Get the nearest neighbor HEALPix index for a (supersampled) regular
+    lat-lon grid and a given nside.
 
     Parameters
     ----------
     nside : int
         The nside parameter for the HEALPix map.
-    lons : array-like
-        Array of longitudes.
-    lats : array-like
-        Array of latitudes.
+    lats : tuple[int, int, int]
+        The latitude range and resolution as (start, end, num_points).
+    lons : tuple[int, int, int]
+        The longitude range and resolution as (start, end, num_points).
+    supersampling : dict, optional
+        The supersampling factors for longitude and latitude.
+        Default is {"lon": 1, "lat": 1}.
+    cache_on_disk : bool, optional
+        If True, the index is also stored in the disk cache. Default is False.
 
     Returns
     -------
@@ -138,13 +207,200 @@ def _get_nn_lon_lat_index(
         DataArray containing the nearest neighbor indices for the given
         longitudes and latitudes.
     """
-    lons2, lats2 = np.meshgrid(lons, lats)
     return xr.DataArray(
-        hp.ang2pix(nside, lons2, lats2, nest=True, lonlat=True),
-        coords=[("lat", lats), ("lon", lons)],
+        get_nn_lonlat_index(
+            nside, lats, lons, supersampling, on_disk=cache_on_disk
+            ),
+        coords=[
+            ("lat", np.linspace(lats[0], lats[1], lats[2]*supersampling['lat'])),
+            ("lon", np.linspace(lons[0], lons[1], lons[2]*supersampling['lon'])),
+            ],
     )
 
 
+def remap_nn_hp2latlon_dataset(
+        ds_hp: xr.Dataset,
+        lats: tuple[int, int, int],
+        lons: tuple[int, int, int],
+        supersampling: dict={"lon": 1, "lat": 1},
+        time_chunk: int=24,
+        cache_on_disk: bool=False,
+        ) -> xr.Dataset:
+    """
+    Remap all variables of a HEALPix dataset to a regular or rectilinear
+    latitude-longitude grid using nearest neighbor interpolation.
+
+    In contrast to calling `remap_nn_hp2latlon` for each variable, the
+    remapping index is built once and the supersampled values are averaged
+    directly while gathering, i.e. the supersampled array is never built.
+    Variables are processed in chunks of `time_chunk` time steps, so that peak
+    memory scales with the chunk size instead of the full time series. Dask
+    arrays stay lazy and are remapped chunk by chunk.
+
+    Parameters
+    ----------
+    ds_hp : xr.Dataset
+        The input dataset on a nested Healpix grid. Only variables with a
+        'cell' dimension are remapped and returned.
+    lats : tuple[int, int, int]
+        A tuple specifying the latitude range and resolution as
+        (start, end, num_points).
+    lons : tuple[int, int, int]
+        A tuple specifying the longitude range and resolution as
+        (start, end, num_points).
+    supersampling : dict, optional
+        A dictionary specifying the supersampling factors for longitude and
+        latitude. Default is {"lon": 1, "lat": 1}.
+    time_chunk : int, optional
+        The number of time steps remapped at once. Default is 24.
+    cache_on_disk : bool, optional
+        If True, the remapping index is also stored in the disk cache of
+        `hp_cache`. Default is False.
+
+    Returns
+    -------
+    xr.Dataset
+        The remapped dataset on a regular or rectilinear latitude-longitude
+        grid. The result is identical to `remap_nn_hp2latlon` applied to each
+        variable.
+    """
+    subsample_idx = _get_subsample_index(
+        get_nn_lonlat_index(
+            egh.get_nside(ds_hp), lats, lons, supersampling,
+            on_disk=cache_on_disk,
+            ),
+        supersampling,
+        )
+    coords = {
+        "lat": np.linspace(lats[0], lats[1], lats[2]*supersampling['lat'])\
+            .reshape(lats[2], supersampling['lat']).mean(axis=-1),
+        "lon": np.linspace(lons[0], lons[1], lons[2]*supersampling['lon'])\
+            .reshape(lons[2], supersampling['lon']).mean(axis=-1),
+        }
+
+    ds_latlon = xr.Dataset({
+        name: _remap_nn_var(var, subsample_idx, time_chunk)
+        for name, var in ds_hp.data_vars.items() if 'cell' in var.dims
+        })
+    return ds_latlon.assign_coords(coords)
+
+
+def _get_subsample_index(
+        idx: np.ndarray,
+        supersampling: dict,
+        ) -> np.ndarray:
+    """
+    Rearranges a supersampled remapping index so that the sub-samples of each
+    target grid point are stacked along the first axis.
+
+    Parameters
+    ----------
+    idx : np.ndarray
+        The remapping index of shape (nlat * supersampling['lat'],
+        nlon * supersampling['lon']).
+    supersampling : dict
+        A dictionary specifying the supersampling factors for longitude and
+        latitude.
+
+    Returns
+    -------
+    np.ndarray
+        The remapping index of shape
+        (supersampling['lat'] * supersampling['lon'], nlat, nlon).
+    """
+    n_lat = idx.shape[0] // supersampling['lat']
+    n_lon = idx.shape[1] // supersampling['lon']
+    return np.ascontiguousarray(
+        idx.reshape(n_lat, supersampling['lat'], n_lon, supersampling['lon'])
+        .transpose(1, 3, 0, 2)
+        .reshape(-1, n_lat, n_lon)
+        )
+
+
+def _remap_nn_var(
+        var: xr.DataArray,
+        subsample_idx: np.ndarray,
+        time_chunk: int,
+        ) -> xr.DataArray:
+    """
+    Remaps a single variable with a precomputed sub-sample index, streaming
+    over chunks of the time dimension.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a Healpix grid with a 'cell' dimension.
+    subsample_idx : np.ndarray
+        The remapping index as returned by `_get_subsample_index`.
+    time_chunk : int
+        The number of time steps remapped at once.
+
+    Returns
+    -------
+    xr.DataArray
+        The remapped data array with the 'cell' dimension replaced by 'lat'
+        and 'lon'.
+    """
+    var = var.drop_vars(
+        [name for name in ('lat', 'lon') if name in var.coords]
+        )
+    kwargs = dict(
+        kwargs={'subsample_idx': subsample_idx},
+        input_core_dims=[['cell']],
+        output_core_dims=[['lat', 'lon']],
+        keep_attrs=True,
+        )
+
+    if var.chunks is not None:
+        chunks = {'cell': -1}
+        if 'time' in var.dims:
+            chunks['time'] = time_chunk
+        return xr.apply_ufunc(
+            _gather_mean, var.chunk(chunks),
+            dask='parallelized',
+            output_dtypes=[np.result_type(var.dtype, np.float32)],
+            dask_gufunc_kwargs={'output_sizes': {
+                'lat': subsample_idx.shape[1], 'lon': subsample_idx.shape[2],
+                }},
+            **kwargs,
+            )
+    if 'time' not in var.dims:
+        return xr.apply_ufunc(_gather_mean, var, **kwargs)
+    return xr.concat([
+        xr.apply_ufunc(
+            _gather_mean, var.isel(time=slice(i, i + time_chunk)), **kwargs
+            )
+        for i in range(0, var['time'].size, time_chunk)
+        ], dim='time')
+
+
+def _gather_mean(data: np.ndarray, subsample_idx: np.ndarray) -> np.ndarray:
+    """
+    Gathers the sub-samples of each target grid point from the last axis of
+    `data` and averages them without building the supersampled array.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The input data with the HEALPix cells along the last axis.
+    subsample_idx : np.ndarray
+        The remapping index as returned by `_get_subsample_index`.
+
+    Returns
+    -------
+    np.ndarray
+        The remapped data with the last axis replaced by (nlat, nlon).
+    """
+    out = np.take(data, subsample_idx[0], axis=-1).astype(
+        np.result_type(data.dtype, np.float32), copy=False
+        )
+    for idx in subsample_idx[1:]:
+        out += np.take(data, idx, axis=-1)
+    if len(subsample_idx) > 1:
+        out /= len(subsample_idx)
+    return out
+
+
 # ------------------------------------------------------------------------------
 # Derivatives on regular or rectilinear lat-lon grids
 # ---------------------------------------------------
@@ -362,6 +618,518 @@ def _deg2rad_coordinates(var_latlon: xr.DataArray) -> xr.DataArray:
         })
 
 
+# ------------------------------------------------------------------------------
+# Fused derivatives on regular or rectilinear lat-lon grids
+# ---------------------------------------------------------
+LATLON_DERIVATIVES = ("gradient", "laplacian", "convergence")
+
+
+def compute_derivatives_on_latlon(
+        var: xr.DataArray=None,
+        products: tuple[str, ...]=("gradient",),
+        ua: xr.DataArray=None,
+        va: xr.DataArray=None,
+        ) -> dict:
+    """
+    Computes a set of cartesian derivative products on regular or rectilinear
+    lat-lon grids in one fused pass.
+
+    The results are identical to `compute_gradient_on_latlon`,
+    `compute_laplacian_on_latlon` and `compute_hor_wind_conv_on_latlon`, but
+    the first derivatives are only computed once and shared between the
+    products, no radian coordinates are attached and the metric terms are
+    cached per grid.
+
+    Parameters
+    ----------
+    var : xr.DataArray, optional
+        The input data array on a regular or rectilinear lat-lon grid. Needed
+        for 'gradient' and 'laplacian'.
+    products : tuple[str, ...], optional
+        The derivative products to compute, any of LATLON_DERIVATIVES.
+        Default is ("gradient",).
+    ua : xr.DataArray, optional
+        The zonal wind on the same grid. Needed for 'convergence'.
+    va : xr.DataArray, optional
+        The meridional wind on the same grid. Needed for 'convergence'.
+
+    Returns
+    -------
+    dict
+        A dictionary with one entry per requested product:
+        - 'gradient': A tuple with the cartesian gradient components
+                      (dvar_dx, dvar_dy).
+        - 'laplacian': The cartesian Laplacian of var.
+        - 'convergence': The horizontal wind convergence of (ua, va).
+    """
+    unknown = set(products) - set(LATLON_DERIVATIVES)
+    if unknown:
+        raise ValueError(
+            f"Unknown derivative products {sorted(unknown)}. Please choose " +
+            f"from {LATLON_DERIVATIVES}."
+            )
+    var_products = [p for p in ("gradient", "laplacian") if p in products]
+    if var_products and var is None:
+        raise ValueError(f"'var' is needed to compute {var_products}.")
+    if "convergence" in products and (ua is None or va is None):
+        raise ValueError("'ua' and 'va' are needed to compute 'convergence'.")
+
+    derivatives = {}
+    if var_products:
+        outputs = _apply_fused_kernel(
+            _fused_var_kernel, [var], var_products, n_outputs=(
+                2*("gradient" in var_products) + ("laplacian" in var_products)
+                ),
+            )
+        if "gradient" in var_products:
+            derivatives["gradient"] = (outputs.pop(0), outputs.pop(0))
+        if "laplacian" in var_products:
+            derivatives["laplacian"] = outputs.pop(0)
+    if "convergence" in products:
+        derivatives["convergence"] = _apply_fused_kernel(
+            _fused_conv_kernel, [ua, va], ["convergence"], n_outputs=1,
+            )[0]
+    return derivatives
+
+
+def _apply_fused_kernel(
+        kernel,
+        fields: list[xr.DataArray],
+        products: list[str],
+        n_outputs: int,
+        ) -> list[xr.DataArray]:
+    """
+    Applies a fused derivative kernel over the 'lat' and 'lon' dimensions of
+    the given fields. Dask arrays are processed lazily chunk by chunk, which
+    requires that 'lat' and 'lon' are not chunked.
+
+    Parameters
+    ----------
+    kernel : callable
+        Either `_fused_var_kernel` or `_fused_conv_kernel`.
+    fields : list[xr.DataArray]
+        The input data arrays on the same regular or rectilinear lat-lon grid.
+    products : list[str]
+        The derivative products passed on to the kernel.
+    n_outputs : int
+        The number of arrays returned by the kernel.
+
+    Returns
+    -------
+    list[xr.DataArray]
+        The kernel outputs with the dimension order of the first field.
+    """
+    metric = _get_latlon_metric(
+        tuple(fields[0]['lat'].values), tuple(fields[0]['lon'].values)
+        )
+    outputs = xr.apply_ufunc(
+        kernel, *fields,
+        kwargs={'metric': metric, 'products': products},
+        input_core_dims=[['lat', 'lon']]*len(fields),
+        output_core_dims=[['lat', 'lon']]*n_outputs,
+        dask='parallelized',
+        output_dtypes=[np.result_type(fields[0].dtype, np.float32)]*n_outputs,
+        )
+    if n_outputs == 1:
+        outputs = (outputs,)
+    return [output.transpose(*fields[0].dims) for output in outputs]
+
+
+@lru_cache(maxsize=8)
+def _get_latlon_metric(lats: tuple, lons: tuple) -> dict:
+    """
+    Computes the metric terms of a regular or rectilinear lat-lon grid. The
+    result is cached per grid.
+
+    Parameters
+    ----------
+    lats : tuple
+        The latitudes of the grid in degrees.
+    lons : tuple
+        The longitudes of the grid in degrees.
+
+    Returns
+    -------
+    dict
+        A dictionary with the coordinates in radians ('lat_rad', 'lon_rad')
+        and the terms 1/cos(lat) ('inv_coslat') and tan(lat) ('tanlat') with
+        shape (lat, 1), so that they broadcast over the longitude axis.
+    """
+    lat_rad = np.deg2rad(np.asarray(lats))
+    return {
+        'lat_rad': lat_rad,
+        'lon_rad': np.deg2rad(np.asarray(lons)),
+        'inv_coslat': (1/np.cos(lat_rad))[:, np.newaxis],
+        'tanlat': np.tan(lat_rad)[:, np.newaxis],
+        }
+
+
+def _fused_var_kernel(
+        var: np.ndarray,
+        metric: dict,
+        products: list[str],
+        ) -> tuple[np.ndarray, ...]:
+    """
+    Computes the gradient and/or Laplacian of var with the latitude and
+    longitude as the last two axes. The first derivatives are computed once
+    and shared between both products.
+
+    Parameters
+    ----------
+    var : np.ndarray
+        The input data with shape (..., lat, lon).
+    metric : dict
+        The metric terms as returned by `_get_latlon_metric`.
+    products : list[str]
+        Any of 'gradient' and 'laplacian'.
+
+    Returns
+    -------
+    tuple[np.ndarray, ...] or np.ndarray
+        (dvar_dx, dvar_dy) if 'gradient' is requested, followed by the
+        Laplacian if 'laplacian' is requested. A single array is returned
+        without a tuple.
+    """
+    dvar_dphi = np.gradient(var, metric['lon_rad'], axis=-1)
+    dvar_dphi *= metric['inv_coslat']
+    dvar_dlambda = np.gradient(var, metric['lat_rad'], axis=-2)
+
+    outputs = ()
+    if "laplacian" in products:
+        laplacian = np.gradient(dvar_dphi, metric['lon_rad'], axis=-1)
+        laplacian *= metric['inv_coslat']
+        laplacian -= np.gradient(dvar_dlambda, metric['lat_rad'], axis=-2)
+        laplacian -= dvar_dlambda * metric['tanlat']
+        laplacian /= EARTH_RADIUS**2
+    if "gradient" in products:
+        outputs += (dvar_dphi/EARTH_RADIUS, dvar_dlambda/EARTH_RADIUS)
+    if "laplacian" in products:
+        outputs += (laplacian,)
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def _fused_conv_kernel(
+        ua: np.ndarray,
+        va: np.ndarray,
+        metric: dict,
+        products: list[str],
+        ) -> np.ndarray:
+    """
+    Computes the horizontal wind convergence with the latitude and longitude
+    as the last two axes.
+
+    Parameters
+    ----------
+    ua : np.ndarray
+        The zonal wind with shape (..., lat, lon).
+    va : np.ndarray
+        The meridional wind with shape (..., lat, lon).
+    metric : dict
+        The metric terms as returned by `_get_latlon_metric`.
+    products : list[str]
+        Unused, only for a common signature with `_fused_var_kernel`.
+
+    Returns
+    -------
+    np.ndarray
+        The horizontal wind convergence.
+    """
+    convergence = np.gradient(ua, metric['lon_rad'], axis=-1)
+    convergence *= -metric['inv_coslat']
+    convergence -= np.gradient(va, metric['lat_rad'], axis=-2)
+    convergence += va * metric['tanlat']
+    convergence /= EARTH_RADIUS
+    return convergence
+
+
+# ------------------------------------------------------------------------------
+# Derivatives on the nested HEALPix grid
+# --------------------------------------
+def compute_gradient_on_hp(
+        var: xr.DataArray
+        ) -> tuple[xr.DataArray, xr.DataArray]:
+    """
+    Computes the cartesian gradient of a variable directly on a nested HEALPix
+    grid with finite differences over the 8 neighbours of each cell.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a nested HEALPix grid. It can be the full
+        globe or a regional subset of cells given by its 'cell' coordinate.
+
+    Returns
+    -------
+    tuple[xr.DataArray, xr.DataArray]
+        A tuple containing:
+        - dvar_dx: Cartesian gradient of the variable towards east.
+        - dvar_dy: Cartesian gradient of the variable towards north.
+
+    Notes
+    -----
+    Cells at the edge of a regional subset, whose stencil is incomplete, are
+    set to NaN. Dask arrays are processed lazily chunk by chunk, with the
+    'cell' dimension in a single chunk.
+    """
+    dvar_dx, dvar_dy = _apply_hp_stencil(var, operators=(0, 1))
+    return dvar_dx, dvar_dy
+
+
+def compute_laplacian_on_hp(var: xr.DataArray) -> xr.DataArray:
+    """
+    Computes the cartesian Laplacian of a variable directly on a nested HEALPix
+    grid with finite differences over the 8 neighbours of each cell.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a nested HEALPix grid. It can be the full
+        globe or a regional subset of cells given by its 'cell' coordinate.
+
+    Returns
+    -------
+    xr.DataArray
+        The cartesian Laplacian of the input variable. Cells at the edge of a
+        regional subset are set to NaN.
+    """
+    return _apply_hp_stencil(var, operators=(2,))[0]
+
+
+def compute_hor_wind_conv_on_hp(
+        ua: xr.DataArray,
+        va: xr.DataArray,
+        ) -> xr.DataArray:
+    """
+    Computes the horizontal wind convergence directly on a nested HEALPix grid
+    with finite differences over the 8 neighbours of each cell.
+
+    Parameters
+    ----------
+    ua : xr.DataArray
+        The zonal wind on a nested HEALPix grid.
+    va : xr.DataArray
+        The meridional wind on the same grid.
+
+    Returns
+    -------
+    xr.DataArray
+        The horizontal wind convergence. Cells at the edge of a regional subset
+        are set to NaN.
+    """
+    dua_dx, = _apply_hp_stencil(ua, operators=(0,))
+    dva_dy, = _apply_hp_stencil(va, operators=(1,))
+    tanlat = np.tan(np.deg2rad(_get_hp_latitude(va)))
+    return -(dua_dx + dva_dy - va * tanlat/EARTH_RADIUS)
+
+
+def _get_hp_latitude(var: xr.DataArray) -> xr.DataArray:
+    """
+    Returns the latitude of each cell of a variable on a nested HEALPix grid,
+    either from its 'lat' coordinate or computed from its 'cell' coordinate.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a nested HEALPix grid.
+
+    Returns
+    -------
+    xr.DataArray
+        The latitude in degrees along the 'cell' dimension.
+    """
+    if 'lat' in var.coords:
+        return var['lat']
+    return xr.DataArray(
+        get_geometry(egh.get_nside(var), "lat")[_get_hp_cells(var)],
+        dims='cell',
+        )
+
+
+def _get_hp_cells(var: xr.DataArray) -> np.ndarray:
+    """
+    Returns the nested HEALPix indices of a variable, either from its 'cell'
+    coordinate or, for a full map without coordinate, as a range.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a nested HEALPix grid.
+
+    Returns
+    -------
+    np.ndarray
+        The nested indices of the cells.
+    """
+    if 'cell' in var.coords:
+        return var['cell'].values.astype(np.int64)
+    return np.arange(var['cell'].size, dtype=np.int64)
+
+
+def _apply_hp_stencil(
+        var: xr.DataArray,
+        operators: tuple[int, ...],
+        ) -> list[xr.DataArray]:
+    """
+    Applies the finite-difference stencils of `hp_cache.get_stencil_weights`
+    to a variable on a nested HEALPix grid.
+
+    Parameters
+    ----------
+    var : xr.DataArray
+        The input data array on a nested HEALPix grid.
+    operators : tuple[int, ...]
+        The stencils to apply: 0 for d/dx, 1 for d/dy and 2 for the Laplacian.
+
+    Returns
+    -------
+    list[xr.DataArray]
+        One data array per operator with the same dimensions as var.
+    """
+    nside = egh.get_nside(var)
+    cells = _get_hp_cells(var)
+    neighbours, is_complete = _get_local_neighbours(nside, cells)
+    weights = _get_local_stencil_weights(nside, cells, operators)
+
+    if var.chunks is not None:
+        var = var.chunk({'cell': -1})
+    outputs = xr.apply_ufunc(
+        _hp_stencil_kernel, var,
+        kwargs={
+            'neighbours': neighbours,
+            'weights': weights,
+            'is_complete': is_complete,
+            },
+        input_core_dims=[['cell']],
+        output_core_dims=[['cell']]*len(operators),
+        dask='parallelized',
+        output_dtypes=[np.result_type(var.dtype, np.float32)]*len(operators),
+        )
+    if len(operators) == 1:
+        outputs = (outputs,)
+    return [output.transpose(*var.dims) for output in outputs]
+
+
+def _get_local_neighbours(
+        nside: int,
+        cells: np.ndarray,
+        ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Translates the global neighbour table to positions within a (possibly
+    regional) set of cells.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    cells : np.ndarray
+        The nested indices of the cells.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        A tuple containing:
+        - neighbours: The positions of the 8 neighbours in cells with shape
+                      (N, 8). Missing neighbours point to the cell itself,
+                      so that their difference is zero.
+        - is_complete: Boolean mask that is False for cells with a neighbour
+                       outside of the given cells.
+    """
+    neighbours = get_neighbour_table(nside)[cells]
+    own_position = np.arange(cells.size)[:, np.newaxis]
+    is_missing = neighbours < 0
+
+    if cells.size == hp.nside2npix(nside):
+        positions = np.where(is_missing, own_position, neighbours)
+        return positions, np.ones(cells.size, dtype=bool)
+
+    order = np.argsort(cells)
+    positions = np.searchsorted(cells, neighbours, sorter=order)
+    positions = order[np.clip(positions, 0, cells.size - 1)]
+    is_outside = (cells[positions] != neighbours) & ~is_missing
+    positions = np.where(is_missing | is_outside, own_position, positions)
+    return positions, ~is_outside.any(axis=-1)
+
+
+def _get_local_stencil_weights(
+        nside: int,
+        cells: np.ndarray,
+        operators: tuple[int, ...],
+        ) -> np.ndarray:
+    """
+    Selects the stencil weights of the given operators and cells from the
+    memory-mapped table of `hp_cache.get_stencil_weights`. The operators are
+    selected first and, if they are consecutive, as a view. The cells are
+    only gathered into memory for a subset of the map, so that a full map
+    reads the table directly.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    cells : np.ndarray
+        The nested indices of the cells.
+    operators : tuple[int, ...]
+        The stencils to select, see `_apply_hp_stencil`.
+
+    Returns
+    -------
+    np.ndarray
+        The stencil weights with shape (N, n_operators, 8).
+    """
+    weights = get_stencil_weights(nside)
+    operators = list(operators)
+    if operators == list(range(operators[0], operators[-1] + 1)):
+        weights = weights[:, operators[0]:operators[-1] + 1]
+    else:
+        weights = weights[:, operators]
+
+    is_full_map = (
+        cells.size == hp.nside2npix(nside)
+        and np.array_equal(cells, np.arange(cells.size))
+        )
+    if is_full_map:
+        return weights
+    return weights[cells]
+
+
+def _hp_stencil_kernel(
+        data: np.ndarray,
+        neighbours: np.ndarray,
+        weights: np.ndarray,
+        is_complete: np.ndarray,
+        ) -> tuple[np.ndarray, ...]:
+    """
+    Applies finite-difference stencils along the last axis of data. The
+    neighbours are gathered one at a time, so that the memory overhead is one
+    array of the size of data per operator.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The input data with the HEALPix cells along the last axis.
+    neighbours : np.ndarray
+        The positions of the 8 neighbours with shape (N, 8).
+    weights : np.ndarray
+        The stencil weights with shape (N, n_operators, 8).
+    is_complete : np.ndarray
+        Boolean mask of the cells with a complete stencil.
+
+    Returns
+    -------
+    tuple[np.ndarray, ...] or np.ndarray
+        One array per operator. A single array is returned without a tuple.
+    """
+    dtype = np.result_type(data.dtype, np.float32)
+    outputs = [np.zeros(data.shape, dtype=dtype) for _ in range(weights.shape[1])]
+    for k in range(neighbours.shape[1]):
+        difference = np.take(data, neighbours[:, k], axis=-1) - data
+        for i, output in enumerate(outputs):
+            output += weights[:, i, k] * difference
+    for output in outputs:
+        output[..., ~is_complete] = np.nan
+    return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
 # ------------------------------------------------------------------------------
 # Helper functions
 # ------------------------------------------------------------------------------
@@ -389,4 +1157,4 @@ def get_ocean_fraction_surface(inpath: Path, hp_zoom: int=9) -> xr.Dataset:
     """
     return xr.open_dataset(
         str(inpath/Path(f'ocean_fraction_surface_hpz{hp_zoom}.nc'))
-        ).pipe(egh.attach_coords)
\ No newline at end of file
+        ).pipe(attach_coords)
\ No newline at end of file
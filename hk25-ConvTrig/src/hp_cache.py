@@ -0,0 +1,424 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import healpix as hp
+import healpy
+
+from constants import EARTH_RADIUS
+
+# Directory in which precomputed HEALPix index tables are stored. The tables
+# only depend on the grid, so they can be shared between sessions and processes.
+CACHE_DIR = Path(
+    os.environ.get("HK25_CACHE_DIR", Path.home()/".cache"/"hk25-convtrig")
+    )
+
+PERMUTATION_DIRECTIONS = ("nest2ring", "ring2nest")
+
+GEOMETRY_FIELDS = ("lon", "lat", "vec", "neighbours") + PERMUTATION_DIRECTIONS
+
+# Maximum number of remapping indices kept in memory. The least recently used
+# index is evicted first.
+REMAP_INDEX_CACHE_SIZE = 16
+
+# Number of cells for which finite-difference stencil weights are fitted at
+# once. Limits the memory of the batched least-squares problem.
+STENCIL_BLOCK_SIZE = 2**18
+
+
+# ------------------------------------------------------------------------------
+# Disk cache
+# ----------
+def _cache_path(name: str, fmt: str="npy") -> Path:
+    """
+    Returns the path of a cached array in the cache directory.
+
+    Parameters
+    ----------
+    name : str
+        The file name of the cached array without suffix.
+    fmt : str, optional
+        The storage format, either 'npy' or 'zarr'. Default is 'npy'.
+
+    Returns
+    -------
+    Path
+        The path of the cached array in CACHE_DIR.
+    """
+    return CACHE_DIR/f"{name}.{fmt}"
+
+
+def _load_or_compute(
+        name: str,
+        compute,
+        use_disk: bool=True,
+        fmt: str="npy",
+        ) -> np.ndarray:
+    """
+    Loads an array from the disk cache or computes and stores it.
+
+    Cached arrays are memory-mapped read-only, so that several processes can
+    share the same table without each holding a copy in memory. Arrays are
+    first written to a temporary file and then moved into place, so that
+    concurrent processes never see a partially written file.
+
+    Parameters
+    ----------
+    name : str
+        The file name of the cached array without suffix.
+    compute : callable
+        A function without arguments that returns the array if it is not
+        cached yet.
+    use_disk : bool, optional
+        If False, always compute the array and do not touch the disk cache.
+        Default is True.
+    fmt : str, optional
+        The storage format on disk, either 'npy' (memory-mapped) or 'zarr'.
+        Default is 'npy'.
+
+    Returns
+    -------
+    np.ndarray
+        The cached or computed array.
+    """
+    if not use_disk:
+        return compute()
+    if fmt not in ("npy", "zarr"):
+        raise ValueError(f"'fmt' needs to be 'npy' or 'zarr', not '{fmt}'.")
+
+    path = _cache_path(name, fmt)
+    if path.exists():
+        if fmt == "npy":
+            return np.load(path, mmap_mode="r")
+        import zarr
+        return zarr.open_array(str(path), mode="r")[...]
+
+    array = compute()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.{fmt}")
+        if fmt == "npy":
+            np.save(tmp_path, array)
+        else:
+            import zarr
+            zarr.save_array(str(tmp_path), array)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is only an optimization, so a read-only or full file
+        # system must not break the computation.
+        pass
+    return array
+
+
+# ------------------------------------------------------------------------------
+# Permutations between nested and ring ordering
+# ---------------------------------------------
+def get_permutation_index(nside: int, direction: str) -> np.ndarray:
+    """
+    Returns the permutation that reorders a full HEALPix map between nested and
+    ring ordering.
+
+    The permutation is computed once for all cells with the vectorized
+    `healpix` routines, stored in the disk cache and kept in memory for later
+    calls.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    direction : str
+        - 'nest2ring': Index array that reorders a nested map into ring
+          ordering, i.e. `var_nest[index]` is in ring ordering. Entry i is the
+          nested index of ring cell i.
+        - 'ring2nest': Index array that reorders a ring map into nested
+          ordering, i.e. `var_ring[index]` is in nested ordering. Entry i is
+          the ring index of nested cell i.
+
+    Returns
+    -------
+    np.ndarray
+        A read-only int64 array of length 12 * nside**2.
+    """
+    if direction not in PERMUTATION_DIRECTIONS:
+        raise ValueError(
+            f"'direction' needs to be one of {PERMUTATION_DIRECTIONS}, " +
+            f"not '{direction}'."
+            )
+    return _get_permutation_index(int(nside), direction)
+
+
+@lru_cache(maxsize=None)
+def _get_permutation_index(nside: int, direction: str) -> np.ndarray:
+    def compute():
+        cells = np.arange(hp.nside2npix(nside), dtype=np.int64)
+        if direction == "nest2ring":
+            return hp.ring2nest(nside, cells).astype(np.int64)
+        return hp.nest2ring(nside, cells).astype(np.int64)
+
+    index = _load_or_compute(f"{direction}_nside{nside}", compute)
+    index.flags.writeable = False
+    return index
+
+
+# ------------------------------------------------------------------------------
+# Nearest-neighbor remapping indices to regular lat-lon grids
+# -----------------------------------------------------------
+def get_nn_lonlat_index(
+        nside: int,
+        lats: tuple[float, float, int],
+        lons: tuple[float, float, int],
+        supersampling: dict={"lon": 1, "lat": 1},
+        on_disk: bool=False,
+        fmt: str="npy",
+        ) -> np.ndarray:
+    """
+    Returns the nearest-neighbor nested HEALPix index of every point of a
+    (supersampled) regular lat-lon grid.
+
+    The index only depends on nside, the lat-lon specification and the
+    supersampling factors. It is kept in an in-memory LRU cache of size
+    REMAP_INDEX_CACHE_SIZE and, if requested, also stored on disk, so that
+    repeated remappings reduce to a gather.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    lats : tuple[float, float, int]
+        The latitude range and resolution as (start, end, num_points).
+    lons : tuple[float, float, int]
+        The longitude range and resolution as (start, end, num_points).
+    supersampling : dict, optional
+        The supersampling factors for longitude and latitude.
+        Default is {"lon": 1, "lat": 1}.
+    on_disk : bool, optional
+        If True, also store the index in CACHE_DIR so that it can be reused by
+        other processes. Default is False.
+    fmt : str, optional
+        The storage format on disk, either 'npy' or 'zarr'. Default is 'npy'.
+
+    Returns
+    -------
+    np.ndarray
+        An int64 array of shape (lats[2] * supersampling['lat'],
+        lons[2] * supersampling['lon']).
+    """
+    return _get_nn_lonlat_index(
+        int(nside),
+        (float(lats[0]), float(lats[1]), int(lats[2])),
+        (float(lons[0]), float(lons[1]), int(lons[2])),
+        int(supersampling["lat"]), int(supersampling["lon"]),
+        on_disk, fmt,
+        )
+
+
+@lru_cache(maxsize=REMAP_INDEX_CACHE_SIZE)
+def _get_nn_lonlat_index(
+        nside: int,
+        lats: tuple[float, float, int],
+        lons: tuple[float, float, int],
+        supersampling_lat: int,
+        supersampling_lon: int,
+        on_disk: bool,
+        fmt: str,
+        ) -> np.ndarray:
+    def compute():
+        lons2, lats2 = np.meshgrid(
+            np.linspace(lons[0], lons[1], lons[2]*supersampling_lon),
+            np.linspace(lats[0], lats[1], lats[2]*supersampling_lat),
+            )
+        return hp.ang2pix(
+            nside, lons2, lats2, nest=True, lonlat=True
+            ).astype(np.int64)
+
+    name = (
+        f"nn_lonlat_nside{nside}_lat{lats[0]}_{lats[1]}_{lats[2]}x" +
+        f"{supersampling_lat}_lon{lons[0]}_{lons[1]}_{lons[2]}x" +
+        f"{supersampling_lon}"
+        )
+    index = _load_or_compute(name, compute, use_disk=on_disk, fmt=fmt)
+    index.flags.writeable = False
+    return index
+
+
+# ------------------------------------------------------------------------------
+# Geometry of the HEALPix grid
+# ----------------------------
+def get_geometry(nside: int, field: str, nest: bool=True) -> np.ndarray:
+    """
+    Returns a geometry field for every cell of a HEALPix map.
+
+    Each field is computed once per (nside, nest), stored in the disk cache
+    and memory-mapped from there, so that later calls and processes only read
+    the pages they need, e.g. when indexing a regional subset of cells.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    field : str
+        One of GEOMETRY_FIELDS:
+        - 'lon': Longitude of the cell centers in degrees within [0, 360).
+        - 'lat': Latitude of the cell centers in degrees.
+        - 'vec': Unit vectors of the cell centers with shape (npix, 3).
+        - 'neighbours': Indices of the SW, W, NW, N, NE, E, SE and S
+          neighbours (see `healpy.get_all_neighbours`) with shape (npix, 8).
+          Missing neighbours are marked with -1.
+        - 'nest2ring', 'ring2nest': Permutations between both orderings (see
+          `get_permutation_index`). They do not depend on nest.
+    nest : bool, optional
+        If True, the cells are in nested ordering, otherwise in ring ordering.
+        Default is True.
+
+    Returns
+    -------
+    np.ndarray
+        A read-only array with the cells along the first axis.
+    """
+    if field not in GEOMETRY_FIELDS:
+        raise ValueError(
+            f"'field' needs to be one of {GEOMETRY_FIELDS}, not '{field}'."
+            )
+    if field in PERMUTATION_DIRECTIONS:
+        return get_permutation_index(nside, field)
+    return _get_geometry(int(nside), field, bool(nest))
+
+
+@lru_cache(maxsize=None)
+def _get_geometry(nside: int, field: str, nest: bool) -> np.ndarray:
+    def compute():
+        cells = np.arange(hp.nside2npix(nside), dtype=np.int64)
+        if field == "neighbours":
+            return np.ascontiguousarray(
+                healpy.get_all_neighbours(nside, cells, nest=nest).T
+                ).astype(np.int64)
+        if field == "vec":
+            return np.stack(hp.pix2vec(nside, cells, nest=nest), axis=-1)
+        lon, lat = hp.pix2ang(nside, cells, nest=nest, lonlat=True)
+        return lon % 360 if field == "lon" else lat
+
+    ordering = "nest" if nest else "ring"
+    array = _load_or_compute(f"{field}_nside{nside}_{ordering}", compute)
+    array.flags.writeable = False
+    return array
+
+
+# ------------------------------------------------------------------------------
+# Finite-difference stencils on the nested HEALPix grid
+# -----------------------------------------------------
+def get_neighbour_table(nside: int) -> np.ndarray:
+    """
+    Returns the 8 neighbours of every cell of a nested HEALPix map. Shorthand
+    for `get_geometry(nside, 'neighbours')`.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+
+    Returns
+    -------
+    np.ndarray
+        A read-only int64 array of shape (12 * nside**2, 8). Missing neighbours
+        are marked with -1.
+    """
+    return get_geometry(nside, "neighbours")
+
+
+def get_stencil_weights(nside: int) -> np.ndarray:
+    """
+    Returns finite-difference stencil weights of the horizontal derivatives
+    for every cell of a nested HEALPix map.
+
+    For each cell, the 8 neighbours are projected onto the tangent plane
+    (gnomonic projection, x towards east and y towards north) and a quadratic
+    polynomial is fitted to the differences to the central cell in the least
+    squares sense. The weights of the linear terms give the gradient and the
+    weights of the quadratic terms give the Laplacian. The derivatives of a
+    field f at a cell are then obtained as the weighted sum of
+    f[neighbour] - f[cell] over the 8 neighbours.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+
+    Returns
+    -------
+    np.ndarray
+        A read-only float32 array of shape (12 * nside**2, 3, 8) with the
+        weights of d/dx [1/m], d/dy [1/m] and the Laplacian [1/m**2]. The
+        weights of missing neighbours are zero.
+    """
+    return _get_stencil_weights(int(nside))
+
+
+@lru_cache(maxsize=None)
+def _get_stencil_weights(nside: int) -> np.ndarray:
+    def compute():
+        neighbours = get_neighbour_table(nside)
+        npix = neighbours.shape[0]
+        weights = np.zeros((npix, 3, 8), dtype=np.float32)
+        for start in range(0, npix, STENCIL_BLOCK_SIZE):
+            cells = np.arange(start, min(start + STENCIL_BLOCK_SIZE, npix))
+            weights[cells] = _fit_stencil_weights(
+                nside, cells, neighbours[cells]
+                )
+        return weights
+
+    weights = _load_or_compute(f"stencil_weights_nside{nside}", compute)
+    weights.flags.writeable = False
+    return weights
+
+
+def _fit_stencil_weights(
+        nside: int,
+        cells: np.ndarray,
+        neighbours: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Fits the stencil weights for a block of cells (see `get_stencil_weights`).
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter of the HEALPix map.
+    cells : np.ndarray
+        The nested indices of the cells, shape (N,).
+    neighbours : np.ndarray
+        The nested indices of the neighbours, shape (N, 8), -1 if missing.
+
+    Returns
+    -------
+    np.ndarray
+        The stencil weights with shape (N, 3, 8).
+    """
+    vec = get_geometry(nside, "vec")
+    center = vec[cells]
+    lon = np.deg2rad(get_geometry(nside, "lon")[cells])
+    lat = np.deg2rad(get_geometry(nside, "lat")[cells])
+    east = np.stack([-np.sin(lon), np.cos(lon), np.zeros_like(lon)], axis=-1)
+    north = np.stack([
+        -np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat),
+        ], axis=-1)
+
+    is_valid = neighbours >= 0
+    points = vec[np.where(is_valid, neighbours, cells[:, np.newaxis])]
+    distance = np.einsum('nkd,nd->nk', points, center)
+    x = EARTH_RADIUS * np.einsum('nkd,nd->nk', points, east) / distance
+    y = EARTH_RADIUS * np.einsum('nkd,nd->nk', points, north) / distance
+
+    # Scale the coordinates by the local grid spacing so that the normal
+    # equations are well conditioned. Rows of missing neighbours are zero and
+    # therefore get zero weight.
+    spacing = np.sqrt(x**2 + y**2).max(axis=-1, keepdims=True)
+    x, y = x/spacing, y/spacing
+    design = np.stack([x, y, x**2, x*y, y**2], axis=-1) * is_valid[..., None]
+    design_t = design.transpose(0, 2, 1)
+    coefficients = np.linalg.solve(design_t @ design, design_t)
+    return np.stack([
+        coefficients[:, 0] / spacing,
+        coefficients[:, 1] / spacing,
+        2*(coefficients[:, 2] + coefficients[:, 4]) / spacing**2,
+        ], axis=1)
@@ -0,0 +1,266 @@
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import xarray as xr
+import healpy as hp
+
+from hp_cache import CACHE_DIR
+from mcs_utils import MCS_TRACK_FILES
+
+# Zoom levels for which the nested HEALPix index of the trigger locations is
+# stored in the catalogue. Indices for other zoom levels are computed on the
+# fly.
+CATALOGUE_ZOOMS = tuple(range(12))
+
+# Variables of the PyFLEXTRKR track files that are needed for the catalogue
+TRACK_FILE_VARS = (
+    'start_split_cloudnumber', 'start_basetime', 'meanlat', 'meanlon',
+    )
+
+
+# ------------------------------------------------------------------------------
+# Functions to build and load the MCS track catalogue
+# ------------------------------------------------------------------------------
+def load_mcs_catalogue(
+        models: Union[str, Sequence[str]],
+        zooms: Sequence[int] = CATALOGUE_ZOOMS,
+        rebuild: bool = False,
+        ) -> xr.Dataset:
+    """
+    Load the catalogue of MCS trigger metadata of one or several models.
+
+    The catalogue of each model is built once from its PyFLEXTRKR track file
+    in `MCS_TRACK_FILES` and stored as a zarr store in CACHE_DIR. Later calls
+    open the store lazily, so that only the variables that are actually used
+    are read. The store is rebuilt if the track file has changed.
+
+    Parameters
+    ----------
+    models : str or Sequence[str]
+        The model name(s) as used in `MCS_TRACK_FILES`.
+    zooms : Sequence[int], optional
+        The zoom levels for which the trigger indices are precomputed when the
+        catalogue is built. Default is CATALOGUE_ZOOMS.
+    rebuild : bool, optional
+        If True, rebuild the catalogue even if a valid store exists.
+        Default is False.
+
+    Returns
+    -------
+    xr.Dataset
+        The lazily loaded catalogue with dimension 'tracks' and the variables
+        'start_basetime', 'start_lat', 'start_lon', 'is_triggered' and
+        'trigger_idx_z{zoom}'. The 'model' coordinate names the model of each
+        track.
+
+    Notes
+    -----
+    - The 'tracks' coordinate holds the track numbers of the track files, which
+        are only unique within one model.
+    """
+    if isinstance(models, str):
+        models = [models]
+
+    catalogues = []
+    for model in models:
+        path = _catalogue_path(model)
+        if rebuild or not _is_catalogue_valid(path, MCS_TRACK_FILES[model]):
+            _write_catalogue(build_mcs_catalogue(model, zooms=zooms), path)
+        catalogue = xr.open_zarr(path)
+        catalogues.append(catalogue.assign_coords(
+            model=('tracks', np.full(catalogue.sizes['tracks'], model))
+            ))
+    if len(catalogues) == 1:
+        return catalogues[0]
+    return xr.concat(catalogues, dim='tracks', data_vars='minimal')
+
+
+def build_mcs_catalogue(
+        model: str,
+        track_file: Optional[str] = None,
+        zooms: Sequence[int] = CATALOGUE_ZOOMS,
+        ) -> xr.Dataset:
+    """
+    Build the catalogue of MCS trigger metadata from a PyFLEXTRKR track file.
+
+    Only the start time, the start location and the splitting information of
+    each track are read from the track file.
+
+    Parameters
+    ----------
+    model : str
+        The model name as used in `MCS_TRACK_FILES`.
+    track_file : str, optional
+        The path to the track file. Defaults to `MCS_TRACK_FILES[model]`.
+    zooms : Sequence[int], optional
+        The zoom levels for which the nested HEALPix index of the trigger
+        locations is precomputed. Default is CATALOGUE_ZOOMS.
+
+    Returns
+    -------
+    xr.Dataset
+        The catalogue with dimension 'tracks' and the variables
+        'start_basetime', 'start_lat', 'start_lon', 'is_triggered' and
+        'trigger_idx_z{zoom}'.
+    """
+    track_file = MCS_TRACK_FILES[model] if track_file is None else track_file
+    mcs_tracks = xr.open_dataset(track_file, chunks={})[list(TRACK_FILE_VARS)]
+    if 'tracks' not in mcs_tracks.coords:
+        mcs_tracks = mcs_tracks.assign_coords(
+            tracks=np.arange(mcs_tracks.sizes['tracks'])
+            )
+
+    catalogue = xr.Dataset(
+        {
+            'start_basetime': mcs_tracks['start_basetime'],
+            'start_lat': mcs_tracks['meanlat'].isel(times=0, drop=True),
+            'start_lon': mcs_tracks['meanlon'].isel(times=0, drop=True),
+            'is_triggered': np.isnan(mcs_tracks['start_split_cloudnumber']),
+            },
+        ).compute()
+
+    for zoom in zooms:
+        catalogue[f'trigger_idx_z{zoom}'] = (
+            'tracks', _get_trigger_idx(catalogue, zoom)
+            )
+    catalogue.attrs = {
+        'model': model,
+        'source_file': str(Path(track_file).resolve()),
+        'source_mtime': os.path.getmtime(track_file),
+        }
+    return catalogue
+
+
+def select_mcs_trigger_locs(
+        catalogue: xr.Dataset,
+        zoom: int,
+        time_range: Optional[Tuple[np.datetime64, np.datetime64]] = None,
+        lat_range: Optional[Tuple[float, float]] = None,
+        lon_range: Optional[Tuple[float, float]] = None,
+        models: Optional[Union[str, Sequence[str]]] = None,
+        triggered_only: bool = True,
+        ) -> xr.Dataset:
+    """
+    Select MCS trigger locations from the catalogue.
+
+    The selection only loads the variables needed for filtering and the
+    trigger index of the requested zoom level.
+
+    Parameters
+    ----------
+    catalogue : xr.Dataset
+        The catalogue as returned by `load_mcs_catalogue`.
+    zoom : int
+        The zoom level of the nested HEALPix grid of the trigger indices.
+    time_range : Tuple[np.datetime64, np.datetime64], optional
+        The open interval of start times of the selected tracks.
+    lat_range : Tuple[float, float], optional
+        The open interval of start latitudes of the selected tracks.
+    lon_range : Tuple[float, float], optional
+        The closed interval of start longitudes of the selected tracks in
+        degrees east. A range with a larger first than second value crosses
+        the date line.
+    models : str or Sequence[str], optional
+        The models of the selected tracks.
+    triggered_only : bool, optional
+        If True, select only tracks that do not start as a split of another
+        track. Default is True.
+
+    Returns
+    -------
+    xr.Dataset
+        The MCS trigger locations with dimension 'tracks' and the variables
+        'start_basetime', 'start_lat', 'start_lon' and 'trigger_idx', as
+        expected by the functions in `mcs_utils`. Tracks without a valid
+        start location are never selected.
+    """
+    columns = catalogue[
+        ['start_basetime', 'start_lat', 'start_lon', 'is_triggered']
+        ].compute()
+
+    # Tracks without a valid start location have no trigger cell
+    mask = np.isfinite(columns['start_lat'].values) & \
+        np.isfinite(columns['start_lon'].values)
+    if triggered_only:
+        mask &= columns['is_triggered'].values
+    if time_range is not None:
+        start_basetime = columns['start_basetime'].values
+        mask &= (start_basetime > time_range[0]) & \
+            (start_basetime < time_range[1])
+    if lat_range is not None:
+        start_lat = columns['start_lat'].values
+        mask &= (start_lat > lat_range[0]) & (start_lat < lat_range[1])
+    if lon_range is not None:
+        width = lon_range[1] - lon_range[0]
+        if width < 360:
+            mask &= (columns['start_lon'].values - lon_range[0]) % 360 \
+                <= width % 360
+    if models is not None:
+        if isinstance(models, str):
+            models = [models]
+        mask &= np.isin(columns['model'].values, models)
+
+    mcs_trigger_locs = columns[
+        ['start_basetime', 'start_lat', 'start_lon']
+        ].isel(tracks=mask)
+    if f'trigger_idx_z{zoom}' in catalogue:
+        trigger_idx = catalogue[f'trigger_idx_z{zoom}'].isel(tracks=mask)\
+            .values
+    else:
+        trigger_idx = _get_trigger_idx(mcs_trigger_locs, zoom)
+    mcs_trigger_locs['trigger_idx'] = ('tracks', trigger_idx.astype(int))
+    return mcs_trigger_locs
+
+
+def _get_trigger_idx(mcs_trigger_locs: xr.Dataset, zoom: int) -> np.ndarray:
+    """
+    Get the nested HEALPix cell index of the start location of each track.
+    Tracks without a valid start location get the index -1.
+    """
+    start_lat = mcs_trigger_locs['start_lat'].values
+    start_lon = mcs_trigger_locs['start_lon'].values
+    is_valid = np.isfinite(start_lat) & np.isfinite(start_lon)
+
+    trigger_idx = np.full(start_lat.shape, -1, dtype=np.int64)
+    trigger_idx[is_valid] = hp.ang2pix(
+        2**zoom, start_lon[is_valid], start_lat[is_valid],
+        nest=True, lonlat=True,
+        )
+    return trigger_idx
+
+
+def _catalogue_path(model: str) -> Path:
+    return CACHE_DIR/f"mcs_catalogue_{model}.zarr"
+
+
+def _is_catalogue_valid(path: Path, track_file: str) -> bool:
+    """
+    Check whether the catalogue store exists and was built from the current
+    version of the track file. If the track file is not available, an
+    existing store is used as is.
+    """
+    if not path.exists():
+        return False
+    if not os.path.exists(track_file):
+        return True
+    attrs = xr.open_zarr(path).attrs
+    return (
+        attrs.get('source_file') == str(Path(track_file).resolve()) and
+        attrs.get('source_mtime') == os.path.getmtime(track_file)
+        )
+
+
+def _write_catalogue(catalogue: xr.Dataset, path: Path) -> None:
+    """
+    Write the catalogue to a temporary store first and move it into place, so
+    that concurrent processes never open a partially written store.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.zarr")
+    catalogue.to_zarr(tmp_path, mode='w')
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
@@ -4,6 +4,8 @@ import healpy as hp
 import easygems.healpix as egh
 from typing import Tuple, Optional
 
+from hp_cache import get_geometry
+
 MCS_TRACK_FILES = {
     "icon_ngc4008": \
         "./../data/icon_ngc4008/mcs_tracks_final_20200101.0000_20201231.2330.nc",
@@ -15,6 +17,10 @@ MCS_TRACK_FILES = {
         "./../data/um_glm_n2560_RAL3p3/mcs_tracks_final_20200201.0000_20210301.0000.nc",
     }
 
+# Number of time steps of the data field that are loaded at once when
+# extracting variables in the trigger areas from data that is not dask-backed
+TIME_BATCH_SIZE = 8
+
 # ------------------------------------------------------------------------------
 # Functions to determine triggering area of MCSs
 # ------------------------------------------------------------------------------
@@ -22,6 +28,7 @@ def add_circular_trigger_areas(
         mcs_trigger_locs: xr.DataArray,
         RADII: np.ndarray,
         hp_grid: str,
+        ragged: bool = False,
         ) -> xr.DataArray:
     """
     Add circular trigger areas to the MCS trigger locations.
@@ -43,6 +50,11 @@ def add_circular_trigger_areas(
     hp_grid : str
         String specifying the Healpix grid configuration. This is used to 
         determine the nside and nesting scheme of the grid.
+    ragged : bool, optional
+        If True, store the trigger areas in the compact ragged layout of
+        `build_trigger_areas` ('trigger_area_start', 'trigger_area_count' and
+        'trigger_area_cells') instead of the NaN-padded 'trigger_area_idxs'.
+        Default is False.
 
     Returns
     -------
@@ -59,31 +71,136 @@ def add_circular_trigger_areas(
         'trigger_area_idxs', which is a 3D array with dimensions corresponding 
         to the number of tracks, the maximum number of cells in any trigger 
         area, and the number of radii in RADII.
+    - Within each trigger area, the cells are ordered by their distance to the
+        trigger location.
     """
     # Determine attributes of the healpix grid
     nside = egh.get_nside(hp_grid)
     nest = True if egh.get_nest(hp_grid) else False
 
-    for i, radius in enumerate(RADII):
-        # Get all pixels within radius around triggering location, i.e. get the
-        # 'triggering area'
-        trigger_area_idxs = [
-            _get_trigger_area_idxs(nside, nest, cell_idx, radius)
-            for cell_idx in mcs_trigger_locs['trigger_idx'].values
-            ]
+    trigger_areas = build_trigger_areas(
+        nside, nest, mcs_trigger_locs['trigger_idx'].values, RADII
+        )
+    trigger_areas = trigger_areas.assign_coords(
+        tracks=mcs_trigger_locs['tracks']
+        )
 
-        if i == 0:
-            # Initialize data_array to save cell indices of the trigger area
-            mcs_trigger_locs['trigger_area_idxs'] = \
-                _init_trigger_area_idxs_array(
-                    mcs_trigger_locs['tracks'].values, trigger_area_idxs,
-                    RADII
-                    )
+    if ragged:
+        return mcs_trigger_locs.assign(trigger_areas)
+    return trigger_areas_to_dense(mcs_trigger_locs.assign(trigger_areas))
 
-        for j, idxs in enumerate(trigger_area_idxs):
-            mcs_trigger_locs['trigger_area_idxs'][j, :idxs.shape[0], i] = idxs
 
-    return mcs_trigger_locs
+def build_trigger_areas(
+        nside: int,
+        nest: bool,
+        trigger_idxs: np.ndarray,
+        radii: np.ndarray,
+        ) -> xr.Dataset:
+    """
+    Build the circular trigger areas of many trigger locations and radii at
+    once in a compact ragged (CSR-style) layout.
+
+    Circular areas around the same location are nested, so only the disc of
+    the largest radius is queried per location. Its cells are sorted by their
+    distance to the location, which makes the area of every smaller radius a
+    prefix of it that is found by distance filtering.
+
+    Parameters
+    ----------
+    nside : int
+        The nside parameter for the HEALPix map.
+    nest : bool
+        If True, use nested indexing. If False, use ring indexing.
+    trigger_idxs : np.ndarray
+        The Healpix cell indices of the trigger locations.
+    radii : np.ndarray
+        The radii of the trigger areas in degrees.
+
+    Returns
+    -------
+    xr.Dataset
+        A Dataset with the variables
+        - 'trigger_area_start' ('tracks'): Position of the first cell of each
+          track in 'trigger_area_cells'.
+        - 'trigger_area_count' ('tracks', 'radius'): Number of cells in the
+          trigger area of each track and radius.
+        - 'trigger_area_cells' ('trigger_area_cell'): Cell indices of all
+          trigger areas of the largest radius, concatenated over tracks.
+        The cells of track j and radius i are
+        trigger_area_cells[start[j]:start[j] + count[j, i]].
+    """
+    trigger_idxs = np.asarray(trigger_idxs).astype(np.int64)
+    radii = np.asarray(radii)
+    vec = get_geometry(nside, "vec", nest)
+
+    # Query only the largest disc around each trigger location
+    largest_areas = [
+        hp.query_disc(
+            nside, vec[cell_idx], np.radians(radii.max()),
+            inclusive=False, nest=nest,
+            )
+        for cell_idx in trigger_idxs
+        ]
+    n_cells = np.array([area.size for area in largest_areas], dtype=np.int64)
+    start = (np.cumsum(n_cells) - n_cells).astype(np.int64)
+    cells = np.concatenate(largest_areas + [np.empty(0, dtype=np.int64)])
+    track = np.repeat(np.arange(trigger_idxs.size), n_cells)
+
+    # Sort the cells of each track by their distance to the trigger location
+    cos_distance = np.einsum(
+        'nd,nd->n', vec[cells], vec[trigger_idxs][track]
+        )
+    order = np.lexsort((-cos_distance, track))
+    cells, cos_distance = cells[order], cos_distance[order]
+
+    count = np.stack([
+        np.bincount(
+            track[cos_distance >= np.cos(np.radians(radius))],
+            minlength=trigger_idxs.size,
+            )
+        for radius in radii
+        ], axis=-1)
+    # The largest area is exactly what query_disc returned
+    count[:, radii == radii.max()] = n_cells[:, np.newaxis]
+
+    trigger_areas = xr.Dataset(
+        data_vars={
+            'trigger_area_start': ('tracks', start),
+            'trigger_area_count': (('tracks', 'radius'), count),
+            'trigger_area_cells': ('trigger_area_cell', cells.astype(np.int64)),
+            },
+        coords={'radius': radii},
+        )
+    trigger_areas['radius'].attrs['units'] = 'degree'
+    return trigger_areas
+
+
+def _ragged_positions(
+        start: np.ndarray,
+        count: np.ndarray,
+        ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Enumerate all elements of a ragged array given by the start position and
+    the number of elements of each row.
+
+    Parameters
+    ----------
+    start : np.ndarray
+        Position of the first element of each row in the flat array.
+    count : np.ndarray
+        Number of elements of each row.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        A tuple containing for every element:
+        - row: The row index.
+        - column: The position within the row.
+        - position: The position in the flat array.
+    """
+    row = np.repeat(np.arange(count.size), count)
+    column = np.arange(row.size) - np.repeat(np.cumsum(count) - count, count)
+    return row, column, start[row] + column
 
 
 def _get_trigger_area_idxs(
@@ -112,13 +229,13 @@ def _get_trigger_area_idxs(
         The indices of the trigger area.
     """
     return hp.query_disc(
-        nside, hp.pix2vec(nside, cell_idx, nest=nest), np.radians(radius_deg),
+        nside, get_geometry(nside, "vec", nest)[cell_idx], np.radians(radius_deg),
         inclusive=False, nest=nest,
     )
 
 def _init_trigger_area_idxs_array(
         tracks: np.ndarray,
-        trigger_area_idxs: list,
+        trigger_area_count: np.ndarray,
         radii: np.ndarray,
         ) -> xr.DataArray:
     """
@@ -131,9 +248,8 @@ def _init_trigger_area_idxs_array(
     tracks : np.ndarray
         An array representing the tracks for which the trigger area indices 
         are being initialized.
-    trigger_area_idxs_list : list
-        A list of arrays, where each array contains the indices of trigger areas 
-        for a specific track.
+    trigger_area_count : np.ndarray
+        The number of cells in the trigger area of each track and radius.
     radii_degree : np.ndarray
         An array of radius values (in degrees) for which the trigger area
         indices are calculated.
@@ -144,9 +260,7 @@ def _init_trigger_area_idxs_array(
         initialized with NaN values, and coordinates corresponding to the input
         parameters.
     """    
-    cells = np.arange(
-        0, np.array([l.shape[0] for l in trigger_area_idxs]).max()
-        )
+    cells = np.arange(0, trigger_area_count.max(initial=0))
 
     trigger_area_idxs_array = xr.DataArray(
         data=np.full(
@@ -160,12 +274,277 @@ def _init_trigger_area_idxs_array(
     return trigger_area_idxs_array
 
 
+# ------------------------------------------------------------------------------
+# Functions to convert between NaN-padded and ragged trigger areas
+# ------------------------------------------------------------------------------
+RAGGED_TRIGGER_AREA_VARS = [
+    'trigger_area_start', 'trigger_area_count', 'trigger_area_cells',
+    ]
+
+
+def trigger_areas_to_ragged(
+        mcs_trigger_locs: xr.Dataset,
+        index_dtype: type = np.int64,
+        ) -> xr.Dataset:
+    """
+    Convert the NaN-padded trigger areas ('trigger_area_idxs') of the MCS
+    trigger locations to the compact ragged layout of `build_trigger_areas`.
+
+    If the trigger areas of all smaller radii are prefixes of the trigger area
+    of the largest radius, as produced by `add_circular_trigger_areas`, the
+    cells are stored only once per track and 'trigger_area_start' has the
+    dimension 'tracks'. Otherwise the trigger area of every radius is stored
+    separately and 'trigger_area_start' has the dimensions
+    ('tracks', 'radius'). In both cases, `trigger_areas_to_dense` restores the
+    original array exactly.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        Dataset containing the MCS trigger locations including
+        'trigger_area_idxs' with dimensions ['tracks', 'cell', 'radius'].
+    index_dtype : type, optional
+        The integer type of the stored cell indices. np.int32 suffices up to
+        zoom level 14. Default is np.int64.
+
+    Returns
+    -------
+    xr.Dataset
+        The MCS trigger locations with 'trigger_area_idxs' and the 'cell'
+        dimension replaced by the variables 'trigger_area_start',
+        'trigger_area_count' and 'trigger_area_cells'.
+    """
+    trigger_area_idxs = mcs_trigger_locs['trigger_area_idxs']\
+        .transpose('tracks', 'cell', 'radius').values
+    is_valid = ~np.isnan(trigger_area_idxs)
+    count = is_valid.sum(axis=1)
+
+    i_max = np.argmax(count.sum(axis=0))
+    largest_area = trigger_area_idxs[:, :, [i_max]]
+    if np.all((trigger_area_idxs == largest_area) | ~is_valid):
+        # Smaller trigger areas are prefixes of the largest one
+        cells = largest_area[is_valid[:, :, [i_max]]]
+        start = np.cumsum(count[:, i_max]) - count[:, i_max]
+        start = ('tracks', start)
+    else:
+        cells = trigger_area_idxs.transpose(0, 2, 1)[is_valid.transpose(0, 2, 1)]
+        start = (np.cumsum(count.ravel()) - count.ravel()).reshape(count.shape)
+        start = (('tracks', 'radius'), start)
+
+    return mcs_trigger_locs.drop_vars(['trigger_area_idxs', 'cell']).assign({
+        'trigger_area_start': start,
+        'trigger_area_count': (('tracks', 'radius'), count),
+        'trigger_area_cells': ('trigger_area_cell', cells.astype(index_dtype)),
+        })
+
+
+def trigger_areas_to_dense(mcs_trigger_locs: xr.Dataset) -> xr.Dataset:
+    """
+    Convert ragged trigger areas (see `build_trigger_areas`) of the MCS
+    trigger locations to the NaN-padded 'trigger_area_idxs' array.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        Dataset containing the MCS trigger locations including
+        'trigger_area_start', 'trigger_area_count' and 'trigger_area_cells'.
+
+    Returns
+    -------
+    xr.Dataset
+        The MCS trigger locations with the ragged variables replaced by
+        'trigger_area_idxs' with dimensions ['tracks', 'cell', 'radius'].
+    """
+    trigger_area_idxs = _init_trigger_area_idxs_array(
+        mcs_trigger_locs['tracks'].values,
+        mcs_trigger_locs['trigger_area_count'].values,
+        mcs_trigger_locs['radius'].values,
+        )
+    trigger_area_idxs['radius'].attrs = mcs_trigger_locs['radius'].attrs
+    for i in range(mcs_trigger_locs['radius'].size):
+        track, cell, position = _ragged_positions(
+            *_get_ragged_start_count(mcs_trigger_locs, i)
+            )
+        trigger_area_idxs.values[track, cell, i] = \
+            mcs_trigger_locs['trigger_area_cells'].values[position]
+
+    mcs_trigger_locs = mcs_trigger_locs.drop_vars(
+        RAGGED_TRIGGER_AREA_VARS
+        )
+    mcs_trigger_locs['trigger_area_idxs'] = trigger_area_idxs
+    return mcs_trigger_locs
+
+
+def var_in_trigger_area_to_ragged(
+        var_in_trigger_area: xr.DataArray,
+        mcs_trigger_locs: xr.Dataset,
+        dtype: type = np.float32,
+        ) -> xr.DataArray:
+    """
+    Convert the NaN-padded variable values in the trigger areas, as returned
+    by `get_var_in_trigger_area`, to values aligned with the
+    'trigger_area_cells' of the ragged trigger locations.
+
+    Parameters
+    ----------
+    var_in_trigger_area : xr.DataArray
+        DataArray with dimensions ['tracks', 'cell', 'radius'] and optionally
+        'time'.
+    mcs_trigger_locs : xr.Dataset
+        The ragged MCS trigger locations the values belong to.
+    dtype : type, optional
+        The float type of the stored values. Default is np.float32.
+
+    Returns
+    -------
+    xr.DataArray
+        The values with dimensions ['trigger_area_cell'] and optionally
+        'time'.
+    """
+    var_in_trigger_area = var_in_trigger_area.transpose(
+        'tracks', 'cell', 'radius', ...
+        )
+    values = np.full(
+        (mcs_trigger_locs['trigger_area_cells'].size,)
+        + var_in_trigger_area.shape[3:],
+        fill_value=np.nan, dtype=dtype,
+        )
+    for i in range(mcs_trigger_locs['radius'].size):
+        track, cell, position = _ragged_positions(
+            *_get_ragged_start_count(mcs_trigger_locs, i)
+            )
+        values[position] = var_in_trigger_area.values[track, cell, i]
+
+    return xr.DataArray(
+        values,
+        dims=['trigger_area_cell'] + list(var_in_trigger_area.dims[3:]),
+        coords={
+            dim: var_in_trigger_area[dim] for dim in var_in_trigger_area.dims[3:]
+            },
+        attrs=var_in_trigger_area.attrs,
+        )
+
+
+def var_in_trigger_area_to_dense(
+        values: xr.DataArray,
+        mcs_trigger_locs: xr.Dataset,
+        ) -> xr.DataArray:
+    """
+    Convert variable values aligned with the 'trigger_area_cells' of ragged
+    trigger locations to the NaN-padded layout of `get_var_in_trigger_area`.
+
+    Parameters
+    ----------
+    values : xr.DataArray
+        The values with dimensions ['trigger_area_cell'] and optionally
+        'time'.
+    mcs_trigger_locs : xr.Dataset
+        The ragged MCS trigger locations the values belong to.
+
+    Returns
+    -------
+    xr.DataArray
+        DataArray with dimensions ['tracks', 'cell', 'radius'] and optionally
+        'time'.
+    """
+    extra_dims = [dim for dim in values.dims if dim != 'trigger_area_cell']
+    values = values.transpose('trigger_area_cell', *extra_dims)
+    var_in_trigger_area = _init_var_in_trigger_area(mcs_trigger_locs)
+    for dim in extra_dims:
+        var_in_trigger_area = var_in_trigger_area.expand_dims(
+            {dim: values[dim].values}, axis=-1,
+            ).copy()
+    var_in_trigger_area.attrs = values.attrs
+
+    for i in range(mcs_trigger_locs['radius'].size):
+        track, cell, position = _ragged_positions(
+            *_get_ragged_start_count(mcs_trigger_locs, i)
+            )
+        var_in_trigger_area.values[track, cell, i] = values.values[position]
+    return var_in_trigger_area
+
+
+def split_trigger_locs(
+        mcs_trigger_locs: xr.Dataset,
+        batch_size: int,
+        ) -> list[xr.Dataset]:
+    """
+    Split the MCS trigger locations into batches of consecutive tracks.
+
+    Ragged trigger areas are compacted per batch, so that every batch only
+    holds the cells of its own tracks. Without any tracks, a single empty
+    batch is returned.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations with NaN-padded or ragged trigger areas.
+    batch_size : int
+        The maximum number of tracks per batch.
+
+    Returns
+    -------
+    list[xr.Dataset]
+        The batches in the layout of the input.
+    """
+    batches = []
+    n_tracks = max(mcs_trigger_locs.sizes['tracks'], 1)
+    for start in range(0, n_tracks, batch_size):
+        batch = mcs_trigger_locs.isel(tracks=slice(start, start + batch_size))
+        if _is_ragged(batch):
+            batch = trigger_areas_to_ragged(
+                trigger_areas_to_dense(batch),
+                index_dtype=batch['trigger_area_cells'].dtype,
+                )
+        batches.append(batch)
+    return batches
+
+
+def _is_ragged(mcs_trigger_locs: xr.Dataset) -> bool:
+    """
+    Check whether the trigger areas of the MCS trigger locations are stored in
+    the ragged layout of `build_trigger_areas`.
+    """
+    return 'trigger_area_cells' in mcs_trigger_locs.variables
+
+
+def _get_ragged_start_count(
+        mcs_trigger_locs: xr.Dataset,
+        i_radius: int,
+        ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the start positions and the number of cells of the ragged trigger
+    areas of all tracks for one radius.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The ragged MCS trigger locations.
+    i_radius : int
+        The position of the radius in the 'radius' dimension.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The start positions in 'trigger_area_cells' and the number of cells.
+    """
+    start = mcs_trigger_locs['trigger_area_start']
+    if 'radius' in start.dims:
+        start = start.isel(radius=i_radius)
+    count = mcs_trigger_locs['trigger_area_count'].isel(radius=i_radius)
+    return (
+        start.transpose('tracks').values.astype(np.int64),
+        count.transpose('tracks').values.astype(np.int64),
+        )
+
+
 # ------------------------------------------------------------------------------
 # Functions to subsample MCSs
 # ------------------------------------------------------------------------------
 def remove_land_triggers(
         mcs_trigger_locs: xr.DataArray,
         ocean_mask: xr.DataArray,
+        min_ocean_fraction: float = 1.,
         ) -> xr.DataArray:
     """
     Removes land-based triggers from the given MCS (Mesoscale Convective
@@ -182,6 +561,9 @@ def remove_land_triggers(
     ocean_mask : xr.DataArray
         An xarray DataArray representing the ocean mask. It is used to determine
         whether the trigger areas are entirely over the ocean.
+    min_ocean_fraction : float, optional
+        The minimum fraction of ocean cells in the largest trigger area of a
+        track to keep it. Defaults to 1, i.e. all-ocean trigger areas.
 
     Returns:
     --------
@@ -190,16 +572,14 @@ def remove_land_triggers(
         that are entirely over the ocean. The returned DataArray has the same
         structure as the input but excludes land-based triggers.
     """
-    mcs_trigger_locs['is_trigger_area_all_ocean'] = (
-        'tracks', _is_max_trigger_area_all_ocean(
-            mcs_trigger_locs, ocean_mask
-            )
+    ocean_fraction = get_trigger_area_ocean_fraction(
+        mcs_trigger_locs, ocean_mask
         )
-    mcs_trigger_locs_ocean = mcs_trigger_locs.where(
-        mcs_trigger_locs['is_trigger_area_all_ocean'] == True, drop=True
+    ocean_fraction = ocean_fraction.sel(
+        radius=mcs_trigger_locs['radius'].max()
         )
-    mcs_trigger_locs_ocean = mcs_trigger_locs_ocean.drop(
-        'is_trigger_area_all_ocean'
+    mcs_trigger_locs_ocean = mcs_trigger_locs.isel(
+        tracks=(ocean_fraction >= min_ocean_fraction).values
         )
     mcs_trigger_locs_ocean['trigger_idx'] = \
         mcs_trigger_locs_ocean['trigger_idx'].astype(int)
@@ -207,25 +587,63 @@ def remove_land_triggers(
     return mcs_trigger_locs_ocean
 
 
-def _is_max_trigger_area_all_ocean(
-        mcs_trigger_locs: xr.DataArray,
-        ocean_mask: xr.DataArray
+def get_trigger_area_ocean_fraction(
+        mcs_trigger_locs: xr.Dataset,
+        ocean_mask: xr.DataArray,
         ) -> xr.DataArray:
-    is_max_trigger_area_all_ocean = []
-    for track in mcs_trigger_locs['tracks']:
-        # Get the trigger area cell indices for current track without filling
-        # NaNs
-        trigger_area_idxs = mcs_trigger_locs['trigger_area_idxs'].sel(
-            radius=mcs_trigger_locs['radius'].max().values,
-            tracks=track,
-            )
-        trigger_area_idxs = trigger_area_idxs[~np.isnan(trigger_area_idxs)]
-        
-        # Check if all cells in the trigger area are ocean
-        is_max_trigger_area_all_ocean.append(
-            all(~np.isnan(ocean_mask.sel(cell=trigger_area_idxs)))
-            )
-    return is_max_trigger_area_all_ocean
+    """
+    Calculate the fraction of ocean cells in the trigger areas of all tracks
+    and radii.
+
+    The ocean mask is read once as a dense boolean array and the cells of all
+    trigger areas are looked up in a single gather. The number of ocean cells
+    per trigger area follows from the cumulative sum over the ragged cells,
+    which allows filtering at different thresholds without repeating the
+    lookup.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations with NaN-padded or ragged trigger areas.
+    ocean_mask : xr.DataArray
+        The ocean mask with a 'cell' dimension, which is NaN over land. Cells
+        are ocean if they are not NaN along all other dimensions.
+
+    Returns
+    -------
+    xr.DataArray
+        The ocean fraction with dimensions ('tracks', 'radius'). It is NaN for
+        empty trigger areas.
+    """
+    if not _is_ragged(mcs_trigger_locs):
+        mcs_trigger_locs = trigger_areas_to_ragged(mcs_trigger_locs)
+    is_ocean = ocean_mask.notnull()
+    is_ocean = is_ocean.all([dim for dim in is_ocean.dims if dim != 'cell'])
+
+    cells = mcs_trigger_locs['trigger_area_cells'].values
+    is_ocean_cell = is_ocean.values[_get_cell_position(is_ocean, cells)]
+    n_ocean_cumulative = np.concatenate(
+        [[0], np.cumsum(is_ocean_cell, dtype=np.int64)]
+        )
+
+    count = mcs_trigger_locs['trigger_area_count'].transpose('tracks', 'radius')
+    start = mcs_trigger_locs['trigger_area_start'].broadcast_like(count)
+    start = start.transpose('tracks', 'radius').values.astype(np.int64)
+    n_ocean = (
+        n_ocean_cumulative[start + count.values]
+        - n_ocean_cumulative[start]
+        )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ocean_fraction = n_ocean / count.values
+
+    return xr.DataArray(
+        ocean_fraction, dims=['tracks', 'radius'],
+        coords={
+            'tracks': mcs_trigger_locs['tracks'],
+            'radius': mcs_trigger_locs['radius'],
+            },
+        name='ocean_fraction',
+        )
 
 
 # ------------------------------------------------------------------------------
@@ -303,24 +721,201 @@ def _get_var_in_trigger_area(
         where 'cells' corresponds to the number of spatial indices in the
         trigger area for each radius.
     """
-    var_in_trigger_area = _init_var_in_trigger_area(mcs_trigger_locs)
-    
-    for j, track in enumerate(mcs_trigger_locs['tracks']):
-        # Subsample the data field for analysis
-        mcs_start_basetime = mcs_trigger_locs.sel(tracks=track)\
-            ['start_basetime'].values
-        var_before_trigger = data_field.sel(
-            time=mcs_start_basetime, method='pad'
+    if not _is_ragged(mcs_trigger_locs):
+        mcs_trigger_locs = trigger_areas_to_ragged(mcs_trigger_locs)
+
+    # Time step of each track and grid position of each trigger area cell
+    i_time = _get_pad_time_index(
+        data_field, mcs_trigger_locs['start_basetime'].values
+        )
+    cell_position = _get_cell_position(
+        data_field, mcs_trigger_locs['trigger_area_cells'].values
+        )
+    track = _get_ragged_track(mcs_trigger_locs)
+
+    values = _gather_by_time(data_field, i_time[track], cell_position)
+    return var_in_trigger_area_to_dense(
+        xr.DataArray(values, dims='trigger_area_cell'), mcs_trigger_locs
+        )
+
+
+def _get_ragged_track(mcs_trigger_locs: xr.Dataset) -> np.ndarray:
+    """
+    Get the position of the track that each cell in 'trigger_area_cells' of
+    ragged trigger locations belongs to.
+
+    Parameters
+    ----------
+    mcs_trigger_locs : xr.Dataset
+        The ragged MCS trigger locations.
+
+    Returns
+    -------
+    np.ndarray
+        The track position along the 'tracks' dimension for every cell.
+    """
+    track = np.zeros(mcs_trigger_locs['trigger_area_cells'].size, dtype=np.int64)
+    for i in range(mcs_trigger_locs['radius'].size):
+        track_i, _, position = _ragged_positions(
+            *_get_ragged_start_count(mcs_trigger_locs, i)
+            )
+        track[position] = track_i
+    return track
+
+
+def _get_pad_time_index(
+        data_field: xr.DataArray,
+        times: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Get the position of the last time step of the data field at or before
+    each of the given times, i.e. `data_field.sel(time=times, method='pad')`.
+
+    Parameters
+    ----------
+    data_field : xr.DataArray
+        The data array with a monotonic 'time' coordinate.
+    times : np.ndarray
+        The times to look up.
+
+    Returns
+    -------
+    np.ndarray
+        The positions along the 'time' dimension.
+
+    Raises
+    ------
+    KeyError
+        If a time is before the first time step of the data field.
+    """
+    i_time = data_field.indexes['time'].get_indexer(times, method='pad')
+    if np.any(i_time < 0):
+        raise KeyError(
+            f"{times[i_time < 0]} are before the first time step of the " +
+            f"data field."
             )
+    return i_time
+
 
-        for i, radius in enumerate(mcs_trigger_locs['radius']):
-            trigger_area_idxs = _select_trigger_area_idxs(
-                mcs_trigger_locs, track, radius
+def _get_cell_position(
+        data_field: xr.DataArray,
+        cells: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Get the position of the given Healpix cells along the 'cell' dimension of
+    the data field, which can be a regional subset of the grid.
+
+    Parameters
+    ----------
+    data_field : xr.DataArray
+        The data array with a 'cell' dimension.
+    cells : np.ndarray
+        The Healpix cell indices to look up.
+
+    Returns
+    -------
+    np.ndarray
+        The positions along the 'cell' dimension.
+
+    Raises
+    ------
+    KeyError
+        If a cell is not part of the data field.
+    ValueError
+        If the data field has no 'cell' index and does not cover the full
+        grid, so that the cell indices can not be used as positions.
+    """
+    if 'cell' not in data_field.indexes:
+        if not hp.isnpixok(data_field.sizes['cell']):
+            raise ValueError(
+                "The data field is a subset of the grid without a 'cell' " +
+                "index. Assign the Healpix cell indices as 'cell' coordinate."
                 )
-            var_in_trigger_area[j, :trigger_area_idxs.shape[0], i] = \
-                var_before_trigger.sel(cell=trigger_area_idxs).data
-    
-    return var_in_trigger_area
+        return cells.astype(np.int64)
+    cell_position = data_field.indexes['cell'].get_indexer(cells)
+    if np.any(cell_position < 0):
+        raise KeyError(
+            f"The cells {np.unique(cells[cell_position < 0])} are not part " +
+            f"of the data field."
+            )
+    return cell_position
+
+
+def _gather_by_time(
+        data_field: xr.DataArray,
+        i_time: np.ndarray,
+        cell_position: np.ndarray,
+        ) -> np.ndarray:
+    """
+    Gather the values of the data field at pairs of time step and cell
+    positions. Every needed time step is loaded only once, in batches given by
+    `_get_time_batches`, and all values of a batch are extracted with a single
+    fancy-index gather. Overlapping time windows of different tracks therefore
+    reuse the loaded time steps. The requests are sorted by time once, so that
+    the requests of each batch are a contiguous slice.
+
+    Parameters
+    ----------
+    data_field : xr.DataArray
+        The data array with dimensions 'time' and 'cell'.
+    i_time : np.ndarray
+        The positions along the 'time' dimension.
+    cell_position : np.ndarray
+        The positions along the 'cell' dimension.
+
+    Returns
+    -------
+    np.ndarray
+        The values of the data field at the given positions.
+    """
+    values = np.full(i_time.shape, np.nan)
+    order = np.argsort(i_time, kind='stable')
+    sorted_i_time = i_time[order]
+    for batch in _get_time_batches(data_field, np.unique(i_time)):
+        data = data_field.isel(time=batch).transpose('time', 'cell').values
+        in_batch = order[
+            np.searchsorted(sorted_i_time, batch[0], side='left'):
+            np.searchsorted(sorted_i_time, batch[-1], side='right')
+            ]
+        values[in_batch] = data[
+            np.searchsorted(batch, i_time[in_batch]), cell_position[in_batch]
+            ]
+    return values
+
+
+def _get_time_batches(
+        data_field: xr.DataArray,
+        unique_i_time: np.ndarray,
+        ) -> list[np.ndarray]:
+    """
+    Split the needed time steps of a data field into batches that are loaded
+    at once. For dask-backed data, each batch contains the needed time steps
+    of one time chunk, so that every chunk is read only once. Otherwise the
+    batches contain TIME_BATCH_SIZE time steps.
+
+    Parameters
+    ----------
+    data_field : xr.DataArray
+        The data array with a 'time' dimension.
+    unique_i_time : np.ndarray
+        The sorted unique positions along the 'time' dimension.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The positions along the 'time' dimension of each batch.
+    """
+    if data_field.chunks is None:
+        return [
+            unique_i_time[start:start + TIME_BATCH_SIZE]
+            for start in range(0, unique_i_time.size, TIME_BATCH_SIZE)
+            ]
+    time_chunks = data_field.chunks[data_field.get_axis_num('time')]
+    chunk_id = np.searchsorted(np.cumsum(time_chunks), unique_i_time, side='right')
+    batches = np.split(
+        unique_i_time, np.flatnonzero(np.diff(chunk_id)) + 1
+        )
+    return [batch for batch in batches if batch.size > 0]
 
 
 def _get_var_in_trigger_area_multiple(
@@ -355,34 +950,39 @@ def _get_var_in_trigger_area_multiple(
         trigger area for each track and radius over the specified time period.
     """
     _check_time_before_trigger_validity(data_field, times_before_trigger)
-    var_in_trigger_area = _init_var_in_trigger_area_multiple(
-        mcs_trigger_locs, data_field, times_before_trigger
-        )
-    
-    for j, track in enumerate(mcs_trigger_locs['tracks']):
-        # Subsample the data fileld for analysis
-        mcs_start_basetime = mcs_trigger_locs.sel(tracks=track)\
-            ['start_basetime'].values
-        pre_mcs_start_basetime = mcs_start_basetime - times_before_trigger
-        if pre_mcs_start_basetime < analysis_time[0]: continue
-
-        analysis_period_end_time = data_field['time'].sel(
-            time=mcs_start_basetime, method='pad'
-            )
-        analysis_period_start_time = analysis_period_end_time - times_before_trigger
-        var_before_trigger = data_field.where(
-            (data_field['time'] > analysis_period_start_time) &
-            (data_field['time'] <= analysis_period_end_time), drop=True
-            )
+    if not _is_ragged(mcs_trigger_locs):
+        mcs_trigger_locs = trigger_areas_to_ragged(mcs_trigger_locs)
+
+    # The window of each track ends at the last time step at or before its
+    # start and covers n_time time steps, so that integer offsets suffice
+    n_time = _get_n_time_before_trigger(data_field, times_before_trigger)
+    offsets = np.arange(-n_time + 1, 1)
+    start_basetime = mcs_trigger_locs['start_basetime'].values
+    i_time = _get_pad_time_index(data_field, start_basetime)
+    if analysis_time is not None:
+        is_analysed = start_basetime - times_before_trigger >= analysis_time[0]
+    else:
+        is_analysed = np.ones(start_basetime.size, dtype=bool)
 
-        for i, radius in enumerate(mcs_trigger_locs['radius']):
-            trigger_area_idxs = _select_trigger_area_idxs(
-                mcs_trigger_locs, track, radius
-                )
-            var_in_trigger_area[j, :trigger_area_idxs.shape[0], i, :] = \
-                var_before_trigger.sel(cell=trigger_area_idxs).data.transpose()
-    
-    return var_in_trigger_area
+    cell_position = _get_cell_position(
+        data_field, mcs_trigger_locs['trigger_area_cells'].values
+        )
+    track = _get_ragged_track(mcs_trigger_locs)
+    i_time = i_time[track, np.newaxis] + offsets
+    is_valid = is_analysed[track, np.newaxis] & (i_time >= 0)
+
+    values = np.full(i_time.shape, np.nan)
+    values[is_valid] = _gather_by_time(
+        data_field, i_time[is_valid],
+        np.broadcast_to(cell_position[:, np.newaxis], i_time.shape)[is_valid],
+        )
+    return var_in_trigger_area_to_dense(
+        xr.DataArray(
+            values, dims=['trigger_area_cell', 'time'],
+            coords={'time': np.arange(-n_time, 0, 1)},
+            ),
+        mcs_trigger_locs,
+        )
 
 
 def _init_var_in_trigger_area(
@@ -408,7 +1008,7 @@ def _init_var_in_trigger_area(
         ['tracks', 'cell', 'radius'] and corresponding coordinates.
     """
     tracks = mcs_trigger_locs['tracks']
-    cells = mcs_trigger_locs['cell']
+    cells = _get_trigger_area_cell_coord(mcs_trigger_locs)
     radii = mcs_trigger_locs['radius']
 
     return xr.DataArray(
@@ -420,84 +1020,54 @@ def _init_var_in_trigger_area(
         )
 
 
-def _init_var_in_trigger_area_multiple(
-        mcs_trigger_locs: xr.DataArray,
-        *vars
-        ) -> xr.DataArray:
+def _get_trigger_area_cell_coord(mcs_trigger_locs: xr.Dataset) -> np.ndarray:
     """
-    Initialize a multi-dimensional xarray.DataArray that stores the variables in
-    the trigger area.
-
-    This function creates an xarray.DataArray with dimensions corresponding to 
-    tracks, cells, radii, and time steps before triggering. The array is filled 
-    with NaN values and is intended to store data for multiple variables in the 
-    trigger area of MCS (Mesoscale Convective Systems).
+    Get the 'cell' coordinate of the NaN-padded trigger areas, i.e. the
+    positions up to the largest number of cells in any trigger area.
 
     Parameters
     ----------
-    mcs_trigger_locs : xr.DataArray
-        An xarray.DataArray containing the MCS trigger locations with dimensions 
-        'tracks', 'cell', and 'radius'.
-    *vars : tuple
-        A variable-length argument list of xarray.DataArray objects, which are 
-        used to determine the number of time steps before triggering.
+    mcs_trigger_locs : xr.Dataset
+        The MCS trigger locations with NaN-padded or ragged trigger areas.
 
     Returns
     -------
-    xr.DataArray
-        An xarray.DataArray initialized with NaN values, with dimensions 
-        ['tracks', 'cell', 'radius', 'time'] and corresponding coordinates.
+    np.ndarray
+        The positions of the cells within the trigger areas.
     """
-    tracks = mcs_trigger_locs['tracks']
-    cells = mcs_trigger_locs['cell']
-    radii = mcs_trigger_locs['radius']
-
-    # Get the number of time steps before triggering
-    i_time_before_trigger = _get_i_time_before_trigger(*vars)
-    time = np.arange(-i_time_before_trigger, 0, 1)
-
-    return xr.DataArray(
-        data=np.full(
-            shape=(tracks.size, cells.size, radii.size, time.size),
-            fill_value=np.nan,
-            ),
-        dims=['tracks', 'cell', 'radius', 'time'],
-        coords={'tracks': tracks, 'cell': cells, 'radius': radii, 'time': time},
-        )
+    if _is_ragged(mcs_trigger_locs):
+        return np.arange(
+            mcs_trigger_locs['trigger_area_count'].values.max(initial=0)
+            )
+    return mcs_trigger_locs['cell'].values
 
 
-def _get_i_time_before_trigger(
+def _get_n_time_before_trigger(
         data_field: xr.DataArray,
         times_before_trigger: np.timedelta64,
         ) -> int:
     """
-    Calculate the number of time steps in a data field that fall within a 
-    specified time range before the last time step.
+    Calculate the number of time steps of a uniformly sampled data field that
+    cover the specified time range before the triggering.
 
     Parameters
     ----------
     data_field : xr.DataArray
-        The data array containing a 'time' coordinate to evaluate.
+        The data array containing a uniformly sampled 'time' coordinate.
     times_before_trigger : np.timedelta64
-        The time duration before the last time step to consider. If None, 
-        defaults to 1 time step.
+        The time duration before the triggering. If None, defaults to 1 time
+        step.
 
     Returns
     -------
     int
         The number of time steps within the specified time range.
     """
-    if times_before_trigger is not None:
-        last_time = data_field['time'].isel(time=-1)
-        start_time = last_time - times_before_trigger
-        data_field = data_field.where(
-            (data_field['time'] >= start_time) &
-            (data_field['time'] < last_time), drop=True
-            )
-        return data_field['time'].size
-    else:
+    if times_before_trigger is None:
         return 1
-    
+    sample_frequency = _get_sample_frequency(data_field)[0]
+    return int(times_before_trigger // sample_frequency)
+
 
 def _get_sample_frequency(data_field: xr.DataArray) -> bool:
     """
@@ -597,6 +1167,13 @@ def _select_trigger_area_idxs(
         A DataArray containing the indices of the trigger area for the 
         specified track and radius, with NaN values removed.
     """
+    if _is_ragged(mcs_trigger_locs):
+        trigger_area = mcs_trigger_locs[
+            ['trigger_area_start', 'trigger_area_count']
+            ].sel(tracks=track, radius=radius)
+        start = int(trigger_area['trigger_area_start'])
+        count = int(trigger_area['trigger_area_count'])
+        return mcs_trigger_locs['trigger_area_cells'][start:start + count]
     trigger_area_idxs = mcs_trigger_locs['trigger_area_idxs']\
         .sel(tracks=track, radius=radius)
     return trigger_area_idxs[~np.isnan(trigger_area_idxs)]
\ No newline at end of file
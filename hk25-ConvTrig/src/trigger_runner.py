@@ -0,0 +1,331 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+import healpy as hp
+
+import mcs_utils
+from hp_cache import get_geometry
+from mcs_catalogue import load_mcs_catalogue, select_mcs_trigger_locs
+
+CATALOG = "https://digital-earths-global-hackathon.github.io/catalog/catalog.yaml"
+LOCATION = "EU"
+TIME = "PT3H"
+
+# Number of tracks whose variables are extracted and written at once. A batch
+# is the unit of work that is skipped when a job is resumed.
+TRACK_BATCH_SIZE = 256
+
+# A job is given as (model, variable, radii, times_before_trigger)
+Job = Tuple[str, str, np.ndarray, Optional[np.timedelta64]]
+
+
+# ------------------------------------------------------------------------------
+# Functions to run the trigger analysis of several models in parallel
+# ------------------------------------------------------------------------------
+def run_trigger_analysis(
+        jobs: Sequence[Job],
+        output_dir: str,
+        analysis_time: Tuple[np.datetime64, np.datetime64],
+        zoom: int = 9,
+        lat_range: Tuple[float, float] = (-15., 15.),
+        open_data: Optional[Callable[[str, int], xr.Dataset]] = None,
+        max_workers: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        ) -> dict:
+    """
+    Run the MCS trigger analysis for a list of jobs in parallel.
+
+    Every job selects the triggered MCSs of a model from the track catalogue,
+    builds their circular trigger areas, removes land triggers and extracts
+    the variable in the trigger areas. The results are written batch-wise to
+    the zarr store '{output_dir}/{model}.zarr' in the group given by
+    `get_job_name`. Batches that were already written are skipped, so that a
+    failed or interrupted run is resumed by calling this function again.
+
+    Parameters
+    ----------
+    jobs : Sequence[Job]
+        The jobs as tuples (model, variable, radii, times_before_trigger),
+        where the radii are in degrees and times_before_trigger may be None.
+    output_dir : str
+        The directory of the zarr stores.
+    analysis_time : Tuple[np.datetime64, np.datetime64]
+        The start and end of the analysis period.
+    zoom : int, optional
+        The zoom level of the simulation data. Default is 9.
+    lat_range : Tuple[float, float], optional
+        The latitude range of the trigger locations. Default is (-15, 15).
+    open_data : Callable[[str, int], xr.Dataset], optional
+        A picklable function that opens the lazily loaded simulation data of a
+        model at a zoom level. Defaults to `open_catalog_data`.
+    max_workers : int, optional
+        The number of worker processes if no executor is given. Defaults to
+        the number of processors.
+    executor : Executor, optional
+        The executor the jobs are submitted to, e.g. the executor of a dask
+        cluster from `Client.get_executor()`. Defaults to a process pool.
+
+    Returns
+    -------
+    dict
+        The paths of the zarr groups of the jobs, keyed by (model, job name).
+
+    Raises
+    ------
+    RuntimeError
+        If any job failed. All other jobs are finished before.
+    """
+    open_data = open_catalog_data if open_data is None else open_data
+    output_dir = Path(output_dir)
+
+    # Fill the shared disk cache once before the workers start, so that they
+    # only memory-map the catalogue and the geometry
+    for model in {job[0] for job in jobs}:
+        load_mcs_catalogue(model)
+    get_geometry(2**zoom, 'vec', nest=True)
+
+    own_executor = executor is None
+    if own_executor:
+        # Forked workers can deadlock on the I/O threads of zarr and dask in
+        # the parent process, so the workers are spawned
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            )
+    try:
+        futures = {
+            (job[0], get_job_name(*job[1:])): executor.submit(
+                run_trigger_analysis_job, job, output_dir, analysis_time,
+                zoom, lat_range, open_data,
+                )
+            for job in jobs
+            }
+        results, errors = {}, {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as error:
+                errors[key] = error
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    if errors:
+        raise RuntimeError(
+            f"The jobs {list(errors)} failed with {list(errors.values())}. " +
+            f"Run them again to resume from the last written batch."
+            )
+    return results
+
+
+def run_trigger_analysis_job(
+        job: Job,
+        output_dir: Path,
+        analysis_time: Tuple[np.datetime64, np.datetime64],
+        zoom: int,
+        lat_range: Tuple[float, float],
+        open_data: Callable[[str, int], xr.Dataset],
+        ) -> Path:
+    """
+    Run the MCS trigger analysis of one job and write its results batch-wise.
+    See `run_trigger_analysis` for the parameters.
+
+    Returns
+    -------
+    Path
+        The path of the zarr group of the job.
+    """
+    model, variable, radii, times_before_trigger = job
+    radii = np.asarray(radii, dtype=float)
+    store = Path(output_dir)/f"{model}.zarr"
+    group = get_job_name(variable, radii, times_before_trigger)
+
+    data = open_data(model, zoom)
+    # The batches only depend on the catalogue and the ocean mask, so they are
+    # the same when a job is resumed
+    batches = mcs_utils.split_trigger_locs(
+        _get_trigger_locs(
+            model, data, radii, analysis_time, zoom, lat_range
+            ),
+        TRACK_BATCH_SIZE,
+        )
+    batch_names = [f"batch_{i:05d}" for i in range(len(batches))]
+    if all((store/group/name).exists() for name in batch_names):
+        return store/group
+
+    data_field = _subset_data(
+        data[variable], analysis_time, lat_range, radii, zoom
+        )
+    for name, mcs_trigger_locs in zip(batch_names, batches):
+        if (store/group/name).exists():
+            continue
+        var_in_trigger_area = mcs_utils.get_var_in_trigger_area(
+            mcs_trigger_locs, data_field,
+            times_before_trigger=times_before_trigger,
+            analysis_time=analysis_time,
+            )
+        _write_batch(
+            var_in_trigger_area.rename(variable).to_dataset(), store, group,
+            name,
+            )
+    return store/group
+
+
+def open_trigger_analysis(
+        output_dir: str,
+        model: str,
+        variable: str,
+        radii: np.ndarray,
+        times_before_trigger: Optional[np.timedelta64] = None,
+        ) -> xr.DataArray:
+    """
+    Open the written results of a job of `run_trigger_analysis`.
+
+    Parameters
+    ----------
+    output_dir : str
+        The directory of the zarr stores.
+    model, variable, radii, times_before_trigger
+        The job specification, see `run_trigger_analysis`.
+
+    Returns
+    -------
+    xr.DataArray
+        The lazily loaded variable in the trigger areas of all written
+        batches, concatenated along 'tracks'.
+    """
+    store = Path(output_dir)/f"{model}.zarr"
+    group = get_job_name(variable, radii, times_before_trigger)
+    batch_names = sorted(
+        path.name for path in (store/group).glob("batch_*")
+        )
+    if not batch_names:
+        raise FileNotFoundError(f"No results of '{group}' in {store}.")
+    return xr.concat(
+        [
+            xr.open_zarr(store, group=f"{group}/{name}",
+                         consolidated=False)[variable]
+            for name in batch_names
+            ],
+        dim='tracks', join='outer',
+        )
+
+
+def get_job_name(
+        variable: str,
+        radii: np.ndarray,
+        times_before_trigger: Optional[np.timedelta64] = None,
+        ) -> str:
+    """
+    Get the name of the zarr group of a job. The radii enter as a short hash,
+    so that jobs with different radii do not overwrite each other.
+    """
+    radii_hash = hashlib.sha1(
+        np.asarray(radii, dtype=float).tobytes()
+        ).hexdigest()[:8]
+    if times_before_trigger is None:
+        return f"{variable}_r{radii_hash}"
+    minutes = int(times_before_trigger / np.timedelta64(1, 'm'))
+    return f"{variable}_r{radii_hash}_tbt{minutes}min"
+
+
+def open_catalog_data(model: str, zoom: int) -> xr.Dataset:
+    """
+    Open the simulation data of a model from the hackathon intake catalog.
+    """
+    import intake
+
+    cat = intake.open_catalog(CATALOG)[LOCATION]
+    return cat[model](zoom=zoom, time=TIME, chunks="auto").to_dask()
+
+
+def _get_trigger_locs(
+        model: str,
+        data: xr.Dataset,
+        radii: np.ndarray,
+        analysis_time: Tuple[np.datetime64, np.datetime64],
+        zoom: int,
+        lat_range: Tuple[float, float],
+        ) -> xr.Dataset:
+    """
+    Get the ragged trigger areas of the triggered MCSs of a model that are
+    entirely over the ocean.
+    """
+    mcs_trigger_locs = select_mcs_trigger_locs(
+        load_mcs_catalogue(model), zoom, time_range=analysis_time,
+        lat_range=lat_range,
+        )
+    trigger_areas = mcs_utils.build_trigger_areas(
+        2**zoom, True, mcs_trigger_locs['trigger_idx'].values, radii
+        )
+    mcs_trigger_locs = mcs_trigger_locs.assign(
+        trigger_areas.assign_coords(tracks=mcs_trigger_locs['tracks'])
+        )
+    return mcs_utils.remove_land_triggers(
+        mcs_trigger_locs, _get_ocean_mask(data)
+        )
+
+
+def _get_ocean_mask(data: xr.Dataset) -> xr.DataArray:
+    """
+    Get the ocean mask of the simulation data, which is NaN over land.
+    """
+    if 'ocean_fraction_surface' in data:
+        ofs = data['ocean_fraction_surface']
+        return ofs.where(ofs == 1)
+    land_mask = data['sftlf']
+    return xr.where(land_mask > 0, np.nan, 1.)
+
+
+def _subset_data(
+        data_field: xr.DataArray,
+        analysis_time: Tuple[np.datetime64, np.datetime64],
+        lat_range: Tuple[float, float],
+        radii: np.ndarray,
+        zoom: int,
+        ) -> xr.DataArray:
+    """
+    Subsample the data field to the analysis period and to the latitudes that
+    the trigger areas can reach.
+    """
+    data_field = data_field.sel(time=slice(*analysis_time))
+    if 'lat' not in data_field.coords:
+        return data_field
+    if 'cell' not in data_field.indexes:
+        # Keep the Healpix cell indices, which are the positions on the full
+        # grid, so that the trigger area cells are found in the subset
+        data_field = data_field.assign_coords(
+            cell=np.arange(data_field.sizes['cell'])
+            )
+    # The trigger areas are centred on the centre of the trigger cell, which
+    # can lie up to one cell radius outside of the latitude range
+    margin = radii.max() + np.rad2deg(hp.max_pixrad(2**zoom))
+    lat = data_field['lat'].values
+    is_in_belt = (lat > lat_range[0] - margin) & (lat < lat_range[1] + margin)
+    return data_field.isel(cell=is_in_belt)
+
+
+def _write_batch(
+        batch: xr.Dataset,
+        store: Path,
+        group: str,
+        name: str,
+        ) -> None:
+    """
+    Write a batch to a temporary group first and move it into place, so that
+    only completely written batches are skipped when a job is resumed.
+    """
+    tmp_name = f".{name}.{os.getpid()}.tmp"
+    batch.to_zarr(store, group=f"{group}/{tmp_name}", mode='w',
+                  consolidated=False)
+    if (store/group/name).exists():
+        shutil.rmtree(store/group/tmp_name)
+        return
+    os.replace(store/group/tmp_name, store/group/name)
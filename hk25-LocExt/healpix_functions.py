@@ -9,12 +9,14 @@ Authors:
 
 """
 
+import functools
+
 import numpy as np
 import xarray as xr
 import healpy as hp
 
 
-def aggregate_grid(arr: np.ndarray, z_out: int, method: str='mean') -> np.ndarray:
+def aggregate_grid(arr: np.ndarray, z_out: int, method: str='mean', skipna: bool=False, weights: np.ndarray=None, min_fraction: float=None, return_count: bool=False):
     """Spatially aggregate to a coarser grid.
 
     Parameters
@@ -30,10 +32,22 @@ def aggregate_grid(arr: np.ndarray, z_out: int, method: str='mean') -> np.ndarra
         - 'std': Standard deviation of sub-grid cells
         - 'min': Minimum of sub-grid cells
         - 'max': Maximum of sub-grid cells
+    skipna : bool, optional, by default False
+        If True, ignore NaN values and aggregate the valid sub-grid cells only.
+        If False, a NaN in any sub-grid cell makes the coarse cell NaN.
+    weights : np.ndarray, shape (M,), optional, by default None
+        Weights of the input cells for 'mean' and 'std', e.g. the valid count
+        returned by a previous aggregation step.
+    min_fraction : float, optional, by default None
+        Set coarse cells to NaN if the fraction of valid sub-grid cells (or of
+        their summed weights) is below this value. Only used with `skipna`.
+    return_count : bool, optional, by default False
+        If True, also return the number (or summed weight) of the valid sub-grid cells.
 
     Returns
     -------
     np.ndarray, shape (N < M,)
+    np.ndarray, shape (N < M,), only if return_count is True
 
     Info
     ----
@@ -64,28 +78,165 @@ def aggregate_grid(arr: np.ndarray, z_out: int, method: str='mean') -> np.ndarra
         11 |  2048 |       3.2 | 50,331,648
         12 |  4096 |       1.6 | 201,326,592
     """
-    npix_in = arr.size
+    if not return_count:
+        return aggregate_grid_stats(arr, z_out, methods=[method], skipna=skipna, weights=weights, min_fraction=min_fraction)[method]
+    stats = aggregate_grid_stats(arr, z_out, methods=[method, 'count'], skipna=skipna, weights=weights, min_fraction=min_fraction)
+    return stats[method], stats['count']
+
+
+AGGREGATION_METHODS = ('mean', 'std', 'min', 'max', 'count')
+
+
+def aggregate_grid_stats(arr: np.ndarray, z_out: int, methods=('mean',), quantiles=None, skipna: bool=False, weights: np.ndarray=None, min_fraction: float=None) -> dict:
+    """Spatially aggregate to a coarser grid with several statistics at once.
+
+    Each block of sub-grid cells is read once and all requested statistics are
+    computed from it, instead of reshaping the input once per statistic.
+
+    Parameters
+    ----------
+    arr : np.ndarray, shape (..., M)
+        The length of the last axis M has to be M = 12 * (2**zoom)**2. Leading
+        axes (e.g., time) are aggregated independently.
+    z_out : int
+        Healpix zoom level of the output grid. Needs to be smaller than the input zoom level.
+    methods : list of str, optional, by default ('mean',)
+        Any of 'mean', 'std', 'min', 'max' (see `aggregate_grid`) and 'count'
+        (number of valid sub-grid cells or, if weights are given, their summed weight).
+    quantiles : list of float, optional, by default None
+        Quantiles (between 0 and 1) of the sub-grid cells. Can not be combined with weights.
+    skipna, weights, min_fraction : optional
+        See `aggregate_grid`. Weights of shape (M,) or broadcastable to `arr`.
+
+    Returns
+    -------
+    dict of np.ndarray, shape (..., N < M)
+        One array per method and, if quantiles are given, an array of shape
+        (len(quantiles), ..., N) with key 'quantiles'.
+    """
+    ratio = _get_aggregation_ratio(arr.shape[-1], z_out)
+    stacked = _aggregate_blocks(arr, ratio, methods, quantiles, skipna, weights, min_fraction)
+    return _unstack_stats(stacked, methods, quantiles, weighted=weights is not None)
+
+
+def _get_aggregation_ratio(npix_in: int, z_out: int) -> int:
+    """Number of sub-grid cells per cell of zoom level `z_out`."""
     npix_out = hp.nside2npix(2**z_out)
-    
+
     if npix_out >= npix_in:
         raise ValueError('Outuput zoom level needs to be smaller than input zoom level')
 
     ratio = npix_in / npix_out
     if not ratio.is_integer():  # this should never happen
         raise ValueError(f'{ratio=}')
+    return int(ratio)
+
+
+def _aggregate_blocks(arr: np.ndarray, ratio: int, methods, quantiles=None, skipna: bool=False, weights=None, min_fraction: float=None) -> np.ndarray:
+    """Compute all statistics of consecutive blocks of `ratio` cells along the last axis.
+
+    In nested ordering the sub-grid cells of each coarse cell are consecutive,
+    so any slice of the grid that starts and ends at a block boundary can be
+    aggregated on its own. Returns the statistics stacked along a new first
+    axis in the order of `methods`, followed by the `quantiles`.
+    """
+    for method in methods:
+        if method not in AGGREGATION_METHODS:
+            raise ValueError(f'{method=}')
+
+    blocks = arr.reshape(*arr.shape[:-1], arr.shape[-1] // ratio, ratio)
+    if skipna or weights is not None:
+        return _aggregate_blocks_weighted(blocks, methods, quantiles, skipna, weights, min_fraction)
+
+    stats = []
+    mean = None
+    for method in methods:
+        if method in ['mean', 'std'] and mean is None:
+            mean = blocks.mean(axis=-1)
+        if method == 'mean':
+            stats.append(mean)
+        elif method == 'std':
+            stats.append(np.sqrt(((blocks - mean[..., None])**2).mean(axis=-1)))
+        elif method == 'min':
+            stats.append(blocks.min(axis=-1))
+        elif method == 'max':
+            stats.append(blocks.max(axis=-1))
+        elif method == 'count':
+            stats.append(np.full(blocks.shape[:-1], ratio))
+    if quantiles is not None and len(quantiles) > 0:
+        stats.extend(np.quantile(blocks, quantiles, axis=-1))
+    return np.stack(stats)
+
+
+def _aggregate_blocks_weighted(blocks: np.ndarray, methods, quantiles=None, skipna: bool=False, weights=None, min_fraction: float=None) -> np.ndarray:
+    """NaN-aware and weighted variant of `_aggregate_blocks` for already reshaped blocks.
+
+    Invalid sub-grid cells get zero weight, so that all statistics are still
+    computed with vectorized reductions over the last axis. Coarse cells
+    without valid sub-grid cells are NaN (and have a count of zero).
+    """
+    if weights is None:
+        weights = np.ones((), dtype=blocks.dtype)
     else:
-        ratio = int(ratio)
-    
-    if method == 'mean':
-        return arr.reshape(npix_out, ratio).mean(axis=-1)
-    if method == 'std':
-        return arr.reshape(npix_out, ratio).std(axis=-1)
-    if method == 'min':
-        return arr.reshape(npix_out, ratio).min(axis=-1)
-    if method == 'max':
-        return arr.reshape(npix_out, ratio).max(axis=-1)
-        
-    raise ValueError(f'{method=}')
+        if quantiles is not None and len(quantiles) > 0:
+            raise ValueError('Quantiles can not be computed with weights')
+        weights = np.asarray(weights)
+        weights = weights.reshape(*weights.shape[:-1], -1, blocks.shape[-1])
+    weights = np.broadcast_to(weights, blocks.shape)
+
+    if skipna:
+        is_valid = ~np.isnan(blocks)
+        values = np.where(is_valid, blocks, 0)
+        weights_valid = np.where(is_valid, weights, 0)
+    else:
+        values = blocks
+        weights_valid = weights
+    count = weights_valid.sum(axis=-1)
+
+    stats = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (weights_valid * values).sum(axis=-1) / count
+        for method in methods:
+            if method == 'mean':
+                stats.append(mean)
+            elif method == 'std':
+                stats.append(np.sqrt((weights_valid * (values - mean[..., None])**2).sum(axis=-1) / count))
+            elif method == 'min':
+                stats.append(np.fmin.reduce(blocks, axis=-1) if skipna else blocks.min(axis=-1))
+            elif method == 'max':
+                stats.append(np.fmax.reduce(blocks, axis=-1) if skipna else blocks.max(axis=-1))
+            elif method == 'count':
+                stats.append(count)
+        if quantiles is not None and len(quantiles) > 0:
+            if skipna:
+                stats.extend(_nanquantile_blocks(blocks, quantiles))
+            else:
+                stats.extend(np.quantile(blocks, quantiles, axis=-1))
+    stats = np.stack(stats)
+
+    if skipna and min_fraction is not None:
+        is_covered = count >= min_fraction * weights.sum(axis=-1)
+        is_stat = np.array([method != 'count' for method in methods] + [True] * (len(stats) - len(methods)))
+        stats[is_stat] = np.where(is_covered, stats[is_stat], np.nan)
+    return stats
+
+
+def _nanquantile_blocks(blocks: np.ndarray, quantiles) -> np.ndarray:
+    """`np.nanquantile` along the last axis without warnings for all-NaN blocks."""
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanquantile(blocks, quantiles, axis=-1)
+
+
+def _unstack_stats(stacked: np.ndarray, methods, quantiles=None, weighted: bool=False) -> dict:
+    """Split the output of `_aggregate_blocks` into a dictionary."""
+    stats = dict(zip(methods, stacked[:len(methods)]))
+    if 'count' in stats and not weighted:
+        stats['count'] = stats['count'].astype(np.int64)
+    if quantiles is not None and len(quantiles) > 0:
+        stats['quantiles'] = stacked[len(methods):]
+    return stats
 
 
 def guess_gridn(da: xr.DataArray) -> str:
@@ -106,9 +257,14 @@ def guess_gridn(da: xr.DataArray) -> str:
     raise ValueError('gridn needs to be set manually to one of: {}'.format(', '.join(dims)))
 
 
-def attach_grid_info(da: xr.DataArray, gridn=None, return_latlon=False) -> xr.Dataset:
+def attach_grid_info(da: xr.DataArray, gridn=None, return_latlon=False, nside=None) -> xr.Dataset:
     """Attach to longitude and latitude values of each grid cell to the Dataset.
 
+    The coordinates are computed only for the cells in `da`, so regional
+    subsets (with their healpix indices as `gridn` coordinate) do not require
+    the full globe. Contiguous ranges of cells are cached per nside. For dask
+    arrays the coordinates are lazy and chunked like the data.
+
     Parameters
     ----------
     da : xr.DataArray
@@ -116,6 +272,10 @@ def attach_grid_info(da: xr.DataArray, gridn=None, return_latlon=False) -> xr.Da
         String specifying the name of the grid variable. If None, try to guess it from frequent options
     return_latlon: bool, optional, by default False
         If True, return the grid values as xr.DataArrays instead of creating a xr.Dataset and attaching them.
+    nside : int, optional, by default None
+        Healpix nside of the grid. If None, it is taken from the 'healpix_nside'
+        attribute of a 'crs' coordinate if present, else from the size of the
+        spatial dimension (which only works for the full grid).
 
     Returns
     -------
@@ -124,17 +284,32 @@ def attach_grid_info(da: xr.DataArray, gridn=None, return_latlon=False) -> xr.Da
     """
     if gridn is None:  # try to guess grid name from frequent options
         gridn = guess_gridn(da)
-        
-    lon, lat = hp.pix2ang(hp.npix2nside(da[gridn].size), da[gridn].values, nest=True, lonlat=True) 
+    if nside is None:
+        nside = _get_nside(da, gridn)
+
+    cells = da[gridn].values
+    if da.chunks is None:
+        lon, lat = _get_lonlat(nside, cells)
+    else:
+        import dask.array as dsa
+
+        lonlat = dsa.map_blocks(
+            _get_lonlat_block, dsa.from_array(cells, chunks=(da.chunks[da.get_axis_num(gridn)],)), nside,
+            new_axis=0, chunks=((2,), da.chunks[da.get_axis_num(gridn)]), dtype=np.float64,
+        )
+        lon, lat = lonlat[0], lonlat[1]
+
     lon = xr.DataArray(
         lon, 
-        coords={gridn: da[gridn].values},
+        dims=gridn,
+        coords={gridn: cells},
         attrs={'units': 'degree_east', 'long_name': 'longitude'},
     )
 
     lat = xr.DataArray(
         lat, 
-        coords={gridn: da[gridn].values},
+        dims=gridn,
+        coords={gridn: cells},
         attrs={'units': 'degree_north', 'long_name': 'latitude'},
     )
 
@@ -149,36 +324,296 @@ def attach_grid_info(da: xr.DataArray, gridn=None, return_latlon=False) -> xr.Da
     ds['lon'] = lon
     ds['lat'] = lat
     return ds
+
+
+def _get_nside(da: xr.DataArray, gridn: str) -> int:
+    """Get the healpix nside from the 'crs' coordinate or the size of the spatial dimension."""
+    if 'crs' in da.coords and 'healpix_nside' in da['crs'].attrs:
+        return int(da['crs'].attrs['healpix_nside'])
+    return hp.npix2nside(da[gridn].size)
+
+
+def _get_lonlat(nside: int, cells: np.ndarray):
+    """Longitude and latitude of nested healpix cells; contiguous ranges are cached."""
+    cells = np.asarray(cells)
+    if cells.ndim == 1 and cells.size > 1 and cells[-1] - cells[0] == cells.size - 1 and np.all(np.diff(cells) == 1):
+        return _get_lonlat_range(nside, int(cells[0]), int(cells[-1]) + 1)
+    return hp.pix2ang(nside, cells, nest=True, lonlat=True)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_lonlat_cache(nside: int) -> dict:
+    """Cache of longitude and latitude per cell range for one nside, see `_get_lonlat_range`."""
+    return {}
+
+
+def _get_lonlat_range(nside: int, start: int, stop: int):
+    """Cached longitude and latitude of the nested healpix cells start, ..., stop - 1.
+
+    All ranges of an nside are kept together, so every spatial chunk of a field is 
+    computed once and the memory is bounded by the cells actually requested.
+    """
+    ranges = _get_lonlat_cache(nside)
+    if (start, stop) not in ranges:
+        lon, lat = hp.pix2ang(nside, np.arange(start, stop), nest=True, lonlat=True)
+        lon.flags.writeable = False
+        lat.flags.writeable = False
+        ranges[(start, stop)] = lon, lat
+    return ranges[(start, stop)]
+
+
+def _get_lonlat_block(cells: np.ndarray, nside: int) -> np.ndarray:
+    """Longitude and latitude of a chunk of cells stacked along a new first axis for `map_blocks`."""
+    return np.stack(_get_lonlat(nside, cells))
     
 
-def aggregate_grid_xr(da: xr.DataArray, z_out: int, method: str='mean', gridn=None) -> xr.DataArray:
+def aggregate_grid_xr(da: xr.DataArray, z_out: int, method: str='mean', gridn=None, skipna: bool=False, weights: xr.DataArray=None, min_fraction: float=None, return_count: bool=False):
     """Thin xarray wrapper for `aggregate_grid'."""
     
     if gridn is None:  # try to guess grid name from frequent options
         gridn = guess_gridn(da)
-            
-    return xr.apply_ufunc(
-        aggregate_grid,
-        da, z_out,
-        input_core_dims=[[gridn], []],
-        output_core_dims=[['tmp']],
-        vectorize=True,
-        kwargs={'method': method},
-    ).rename({'tmp': gridn})
-
-
-def subgrid_anomaly(fine: np.ndarray, z_coarse=None, coarse: np.ndarray=None) -> np.ndarray:
+
+    methods = [method, 'count'] if return_count else [method]
+    ds = aggregate_grid_stats_xr(da, z_out, methods=methods, gridn=gridn, skipna=skipna, weights=weights, min_fraction=min_fraction)
+    if return_count:
+        return ds[method].rename(da.name), ds['count']
+    return ds[method].rename(da.name)
+
+
+def aggregate_grid_stats_xr(da: xr.DataArray, z_out: int, methods=('mean',), quantiles=None, gridn=None, skipna: bool=False, weights: xr.DataArray=None, min_fraction: float=None) -> xr.Dataset:
+    """Dask-native xarray wrapper for `aggregate_grid_stats`.
+
+    Instead of looping over all non-spatial indices with `vectorize=True`,
+    the kernel is applied to whole arrays or, for dask arrays, mapped over the
+    chunks. Chunks along the spatial dimension are aligned to blocks of
+    sub-grid cells, so that each input chunk is read once for all statistics.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Data on the full nested healpix grid.
+    z_out : int
+        Healpix zoom level of the output grid.
+    methods : list of str, optional, by default ('mean',)
+        See `aggregate_grid_stats`.
+    quantiles : list of float, optional, by default None
+        See `aggregate_grid_stats`.
+    gridn : string, optional, by default None
+        String specifying the name of the grid variable. If None, try to guess it from frequent options
+    skipna, min_fraction : optional
+        See `aggregate_grid`.
+    weights : xr.DataArray, optional, by default None
+        Weights of the input cells, with the spatial dimension and optionally
+        any of the other dimensions of `da`.
+
+    Returns
+    -------
+    xr.Dataset
+        One variable per method and, if quantiles are given, the variable
+        'quantiles' with the additional dimension 'quantile'. The spatial
+        dimension is moved to the end.
+    """
+    if gridn is None:  # try to guess grid name from frequent options
+        gridn = guess_gridn(da)
+
+    da = da.transpose(..., gridn)
+    ratio = _get_aggregation_ratio(da[gridn].size, z_out)
+    n_stats = len(methods) + (0 if quantiles is None else len(quantiles))
+
+    if weights is not None:
+        weights = weights.broadcast_like(da).transpose(*da.dims)
+
+    if da.chunks is None and (weights is None or weights.chunks is None):
+        stacked = _aggregate_blocks(da.values, ratio, methods, quantiles, skipna, None if weights is None else weights.values, min_fraction)
+    else:
+        import dask.array as dsa
+
+        data = _align_grid_chunks(dsa.asarray(da.data), ratio)
+        args = [data] if weights is None else [data, dsa.asarray(weights.data).rechunk(data.chunks)]
+        probe = [np.zeros(ratio, dtype=arg.dtype) for arg in args]
+        stacked = dsa.map_blocks(
+            _aggregate_stacked_blocks, *args, ratio=ratio, methods=methods, quantiles=quantiles, skipna=skipna, min_fraction=min_fraction,
+            new_axis=0,
+            chunks=((n_stats,), *data.chunks[:-1], tuple(c // ratio for c in data.chunks[-1])),
+            dtype=_aggregate_stacked_blocks(*probe, ratio=ratio, methods=methods, quantiles=quantiles, skipna=skipna).dtype,
+        )
+
+    dims = [dim for dim in da.dims]
+    coords = {key: value for key, value in da.coords.items() if gridn not in value.dims}
+    ds = xr.Dataset(coords=coords)
+    for name, value in _unstack_stats(stacked, methods, quantiles, weighted=weights is not None).items():
+        if name == 'quantiles':
+            ds[name] = xr.DataArray(value, dims=['quantile', *dims], coords={'quantile': list(quantiles)})
+        else:
+            ds[name] = xr.DataArray(value, dims=dims, attrs=da.attrs if name != 'count' else {})
+    return ds
+
+
+def _aggregate_stacked_blocks(arr, weights=None, *, ratio, methods, quantiles=None, skipna=False, min_fraction=None):
+    """Keyword version of `_aggregate_blocks` for `map_blocks` with optional weights."""
+    return _aggregate_blocks(arr, ratio, methods, quantiles, skipna, weights, min_fraction)
+
+
+def _align_grid_chunks(data, ratio: int):
+    """Rechunk the last (spatial) axis of a dask array to multiples of `ratio` if needed."""
+    chunks = data.chunks[-1]
+    if all(c % ratio == 0 for c in chunks):
+        return data
+    size = max(ratio, (max(chunks) // ratio) * ratio)
+    return data.rechunk({data.ndim - 1: size})
+
+
+def build_zoom_pyramid(da: xr.DataArray, z_min: int=0, store=None, skipna: bool=False, weights: xr.DataArray=None, gridn=None) -> dict:
+    """Aggregate to all coarser zoom levels in one pass over the data.
+
+    Each chunk of the input is aligned to whole cells of zoom level `z_min`
+    and read once. All coarser levels are then computed from it, each parent
+    cell from its four children, and written to one zarr group per level with
+    the same chunking along the non-spatial dimensions. This replaces chained
+    calls of `aggregate_grid` or `coarsen(cell=4).mean()`, which read the
+    source again for every level.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Data on the full nested healpix grid, optionally dask-backed.
+    z_min : int, optional, by default 0
+        Coarsest zoom level of the pyramid.
+    store : str or zarr store, optional, by default None
+        Output zarr store with one group 'z{zoom}' per level. If None, the
+        levels are computed in memory.
+    skipna : bool, optional, by default False
+        If True, ignore NaN values and average over the valid sub-grid cells
+        only. If False, a NaN in any sub-grid cell propagates (as `aggregate_grid`).
+    weights : xr.DataArray, optional, by default None
+        Weights of the input cells along the spatial dimension, e.g. a land
+        fraction. If given, weighted means are computed.
+    gridn : string, optional, by default None
+        String specifying the name of the grid variable. If None, try to guess it from frequent options
+
+    Returns
+    -------
+    dict of xr.Dataset
+        For each zoom level from `z_min` to the input zoom level minus one a
+        Dataset with the mean (named as `da` or 'data') and, if `skipna` or
+        `weights` are set, the summed weight of the valid sub-grid cells
+        ('weight'). The Datasets are opened lazily from `store` if given.
+    """
+    if gridn is None:  # try to guess grid name from frequent options
+        gridn = guess_gridn(da)
+
+    name = 'data' if da.name is None else da.name
+    da = da.transpose(..., gridn)
+    z_in = hp.npix2order(da[gridn].size)
+    zooms = list(range(z_in - 1, z_min - 1, -1))
+    if len(zooms) == 0:
+        raise ValueError('Outuput zoom level needs to be smaller than input zoom level')
+
+    if weights is not None:
+        weights = weights.transpose(gridn).data
+
+    if store is None:
+        levels = _pyramid_block(da.values, None if weights is None else np.asarray(weights), len(zooms), skipna, skipna or weights is not None)
+        return {zoom: _pyramid_level_to_dataset(da, gridn, name, *level) for zoom, level in zip(zooms, levels)}
+
+    import dask
+    import dask.array as dsa
+
+    data = _align_grid_chunks(dsa.asarray(da.data), 4**(z_in - z_min))
+    if weights is not None:
+        weights = dsa.asarray(weights).rechunk((data.chunks[-1],))
+
+    for zoom in zooms:
+        ratio = 4**(z_in - zoom)
+        level_chunks = (*data.chunks[:-1], tuple(c // ratio for c in data.chunks[-1]))
+        template = dsa.zeros((*data.shape[:-1], data.shape[-1] // ratio), chunks=level_chunks, dtype=_pyramid_dtype(data.dtype))
+        level = _pyramid_level_to_dataset(da, gridn, name, template, template if skipna or weights is not None else None)
+        level.to_zarr(store, group=f'z{zoom}', mode='w', compute=False)
+
+    offsets = [np.cumsum((0,) + chunks[:-1]) for chunks in data.chunks]
+    tasks = []
+    for index, block in zip(np.ndindex(*data.numblocks), data.to_delayed().ravel()):
+        weight_block = None if weights is None else weights.to_delayed()[index[-1]]
+        region = [offsets[axis][i] for axis, i in enumerate(index)]
+        tasks.append(dask.delayed(_write_pyramid_block)(
+            block, weight_block, region, da.dims, store, name, zooms, z_in, skipna, skipna or weights is not None,
+        ))
+    dask.compute(*tasks)
+    return {zoom: xr.open_zarr(store, group=f'z{zoom}') for zoom in zooms}
+
+
+def _pyramid_dtype(dtype):
+    """Output type of the pyramid means: float32 input stays float32."""
+    return np.float32 if dtype == np.float32 else np.float64
+
+
+def _pyramid_block(values: np.ndarray, weights, n_levels: int, skipna: bool, return_weight: bool) -> list:
+    """Compute `n_levels` successively coarser levels of a block of cells along the last axis.
+
+    Weighted sums and summed weights are accumulated in float64 and each
+    parent is formed from its four children, so the means of all levels are
+    exact weighted means of the input cells.
+    """
+    values = values.astype(np.float64)
+    weights = np.ones(values.shape[-1]) if weights is None else np.asarray(weights, dtype=np.float64)
+    weights = np.broadcast_to(weights, values.shape)
+    if skipna:
+        is_valid = ~np.isnan(values)
+        weighted_sum = np.where(is_valid, weights * values, 0)
+        weight = np.where(is_valid, weights, 0)
+    else:
+        weighted_sum = weights * values
+        weight = weights
+
+    levels = []
+    for _ in range(n_levels):
+        weighted_sum = weighted_sum.reshape(*values.shape[:-1], -1, 4).sum(axis=-1)
+        weight = weight.reshape(*values.shape[:-1], -1, 4).sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = weighted_sum / weight
+        levels.append((mean, weight if return_weight else None))
+    return levels
+
+
+def _pyramid_level_to_dataset(da: xr.DataArray, gridn: str, name: str, mean, weight=None) -> xr.Dataset:
+    """Wrap one pyramid level in a Dataset with the non-spatial coordinates of `da`."""
+    coords = {key: value for key, value in da.coords.items() if gridn not in value.dims}
+    ds = xr.Dataset(coords=coords)
+    ds[name] = xr.DataArray(mean.astype(_pyramid_dtype(da.dtype), copy=False), dims=da.dims, attrs=da.attrs)
+    if weight is not None:
+        ds['weight'] = xr.DataArray(weight, dims=da.dims)
+    return ds
+
+
+def _write_pyramid_block(block, weights, region, dims, store, name, zooms, z_in, skipna, return_weight):
+    """Compute all levels of one input chunk and write them to their regions in the zarr store."""
+    levels = _pyramid_block(block, weights, len(zooms), skipna, return_weight)
+    for zoom, (mean, weight) in zip(zooms, levels):
+        ratio = 4**(z_in - zoom)
+        level_region = {dim: slice(start, start + size) for dim, start, size in zip(dims[:-1], region[:-1], mean.shape[:-1])}
+        level_region[dims[-1]] = slice(region[-1] // ratio, region[-1] // ratio + mean.shape[-1])
+        ds = xr.Dataset({name: (dims, mean.astype(_pyramid_dtype(block.dtype), copy=False))})
+        if return_weight:
+            ds['weight'] = (dims, weight)
+        ds.to_zarr(store, group=f'z{zoom}', region=level_region)
+
+
+def subgrid_anomaly(fine: np.ndarray, z_coarse=None, coarse: np.ndarray=None, return_coarse: bool=False):
     """Calculate the sub grid anomaly as difference of a fine grid minus a coarse grid. Output is on the fine grid.
 
     Parameters
     ----------
-    fine : np.ndarray, shape (M,)
+    fine : np.ndarray, shape (..., M)
     z_coarse : int, optional
-    coarse : np.ndarray, optional, shape (N < M,)
+    coarse : np.ndarray, optional, shape (..., N < M)
+        Leading axes need to be broadcastable to the ones of `fine`.
+    return_coarse : bool, optional, by default False
+        If True, also return the coarse grid.
 
     Returns
     -------
-    np.ndarray, shape (M,)
+    np.ndarray, shape (..., M)
+    np.ndarray, shape (..., N), only if return_coarse is True
 
     Info
     ----
@@ -186,18 +621,18 @@ def subgrid_anomaly(fine: np.ndarray, z_coarse=None, coarse: np.ndarray=None) ->
 
     Alternatively data on a coarse grid can be provided (e.g., by first calculating them using `aggregate_grid`). This can also be used to calculate the difference between two different datasets on different zoom levels (e.g., an extreme index calculated on a fine grid against an extreme index calculated on a coarse grid)
     """
-    npix_fine = fine.size
+    npix_fine = fine.shape[-1]
 
     if coarse is None:
         if z_coarse is None:
             raise ValueError('Either `coarse` or `z_coarse` needs to be set')
         npix_coarse = hp.order2npix(z_coarse)
     elif z_coarse is None:
-        npix_coarse = coarse.size
+        npix_coarse = coarse.shape[-1]
     else:
-        if hp.order2npix(z_coarse) != coarse.size:
+        if hp.order2npix(z_coarse) != coarse.shape[-1]:
             raise ValueError('If `coarse` and `z_coarse` are given, theny need to be consistent')
-        npix_coarse = coarse.size
+        npix_coarse = coarse.shape[-1]
 
 
     if npix_coarse > npix_fine:
@@ -209,32 +644,274 @@ def subgrid_anomaly(fine: np.ndarray, z_coarse=None, coarse: np.ndarray=None) ->
     else:
         ratio = int(ratio)
 
-    if coarse is not None:
-        return (fine.reshape(npix_coarse, ratio) - coarse.reshape(npix_coarse, 1)).ravel()
-    return (fine.reshape(npix_coarse, ratio) - aggregate_grid(fine, z_coarse).reshape(npix_coarse, 1)).ravel()
+    if coarse is None:
+        coarse = _aggregate_mean_blocks(fine, ratio)
+    anomaly = _subtract_coarse(fine, coarse)
+    if return_coarse:
+        return anomaly, coarse
+    return anomaly
+
+
+def _subtract_coarse(fine: np.ndarray, coarse: np.ndarray) -> np.ndarray:
+    """Subtract each coarse cell from its sub-grid cells by broadcasting over blocks along the last axis."""
+    ratio = fine.shape[-1] // coarse.shape[-1]
+    blocks = fine.reshape(*fine.shape[:-1], coarse.shape[-1], ratio)
+    anomaly = blocks - coarse[..., None]
+    return anomaly.reshape(*anomaly.shape[:-2], fine.shape[-1])
+
 
 
+def subgrid_anomaly_xr(da_fine, z_coarse=None, da_coarse=None, gridn=None, return_coarse=False):
+    """Block-wise xarray wrapper for `subgrid_anomaly`.
 
-def subgrid_anomaly_xr(da_fine, z_coarse=None, da_coarse=None, gridn=None):
-    """Thin xarray wrapper for `subgrid_anomaly`."""
+    The anomaly is computed for whole arrays or, for dask arrays, chunk by
+    chunk with the spatial chunks aligned to blocks of sub-grid cells, so the
+    result stays lazy. If `da_coarse` is not given, the coarse grid is computed
+    from the same chunks and can be returned together with the anomaly.
+
+    Parameters
+    ----------
+    da_fine : xr.DataArray
+    z_coarse : int, optional
+    da_coarse : xr.DataArray, optional
+        Data on the coarse grid. Its non-spatial dimensions are broadcast against `da_fine`.
+    gridn : string, optional, by default None
+        String specifying the name of the grid variable. If None, try to guess it from frequent options
+    return_coarse : bool, optional, by default False
+        If True, also return the coarse grid.
+
+    Returns
+    -------
+    xr.DataArray
+        The anomaly on the fine grid with the spatial dimension moved to the end.
+    xr.DataArray, only if return_coarse is True
+    """
     if gridn is None:  # try to guess grid name from frequent options
         gridn = guess_gridn(da_fine)
 
+    da_fine = da_fine.transpose(..., gridn)
+    dims = list(da_fine.dims)
+    npix_fine = da_fine[gridn].size
+    if da_coarse is None:
+        if z_coarse is None:
+            raise ValueError('Either `coarse` or `z_coarse` needs to be set')
+        ratio = _get_aggregation_ratio(npix_fine, z_coarse)
+    else:
+        npix_coarse = da_coarse[gridn].size
+        if z_coarse is not None and hp.order2npix(z_coarse) != npix_coarse:
+            raise ValueError('If `coarse` and `z_coarse` are given, theny need to be consistent')
+        if npix_coarse > npix_fine:
+            raise ValueError('`fine` needs to have a higher zoom levels than `coarse`')
+        ratio = _get_aggregation_ratio(npix_fine, hp.npix2order(npix_coarse))
+        da_coarse = da_coarse.broadcast_like(da_fine.isel({gridn: 0}, drop=True)).transpose(*dims)
+
+    is_lazy = da_fine.chunks is not None or (da_coarse is not None and da_coarse.chunks is not None)
+    if not is_lazy:
+        fine = da_fine.values
+        coarse = _aggregate_mean_blocks(fine, ratio) if da_coarse is None else da_coarse.values
+        anomaly = _subtract_coarse(fine, coarse)
+    else:
+        import dask.array as dsa
+
+        fine = _align_grid_chunks(dsa.asarray(da_fine.data), ratio)
+        coarse_chunks = (*fine.chunks[:-1], tuple(c // ratio for c in fine.chunks[-1]))
+        if da_coarse is None:
+            coarse = dsa.map_blocks(
+                _aggregate_mean_blocks, fine, ratio,
+                chunks=coarse_chunks,
+                dtype=_aggregate_mean_blocks(np.zeros(ratio, dtype=fine.dtype), ratio).dtype,
+            )
+        else:
+            coarse = dsa.asarray(da_coarse.data).rechunk(coarse_chunks)
+        anomaly = dsa.map_blocks(
+            _subtract_coarse, fine, coarse,
+            dtype=np.result_type(fine.dtype, coarse.dtype),
+        )
+
+    da_anomaly = xr.DataArray(anomaly, dims=dims, coords=da_fine.coords, name=da_fine.name, attrs=da_fine.attrs)
+    if not return_coarse:
+        return da_anomaly
+
     if da_coarse is not None:
-        return xr.apply_ufunc(
-            subgrid_anomaly,
-            da_fine, da_coarse.rename({gridn: 'tmp'}),
-            input_core_dims=[[gridn], ['tmp']],
-            output_core_dims=[[gridn]],
-            vectorize=True,
-            kwargs={'z_coarse': z_coarse},
+        return da_anomaly, da_coarse
+    coords = {key: value for key, value in da_fine.coords.items() if gridn not in value.dims}
+    return da_anomaly, xr.DataArray(coarse, dims=dims, coords=coords, name=da_fine.name, attrs=da_fine.attrs)
+
+
+def _aggregate_mean_blocks(arr: np.ndarray, ratio: int) -> np.ndarray:
+    """Mean of consecutive blocks of `ratio` cells along the last axis."""
+    return _aggregate_blocks(arr, ratio, ['mean'])[0]
+
+
+def subgrid_variance_decomposition(arr: np.ndarray, z_min: int=0, return_anomalies: bool=False):
+    """Decompose the sub-grid variance into contributions between successive zoom levels.
+
+    The means of all zoom levels from the input zoom level down to `z_min`
+    are computed in one walk of the nested hierarchy. The local anomaly at
+    zoom level z is the difference of each cell mean at level z to the mean of
+    its parent at level z-1. Because the cells of each level have equal area,
+    these anomalies are orthogonal and their variances add up to the total
+    variance of the input around its mean at level `z_min`.
+
+    Parameters
+    ----------
+    arr : np.ndarray, shape (..., M)
+        The length of the last axis M has to be M = 12 * (2**zoom)**2.
+    z_min : int, optional, by default 0
+        Coarsest zoom level of the decomposition.
+    return_anomalies : bool, optional, by default False
+        If True, also return the local anomalies at every level and the mean at level `z_min`.
+
+    Returns
+    -------
+    np.ndarray, shape (L, ...)
+        Variance spectrum: the mean squared local anomaly for the L zoom levels
+        z_min + 1, ..., zoom (in this order).
+    dict of np.ndarray, shape (..., 12 * (2**z)**2), only if return_anomalies is True
+        Local anomalies by zoom level z.
+    np.ndarray, shape (..., 12 * (2**z_min)**2), only if return_anomalies is True
+        Mean at zoom level `z_min`.
+
+    Info
+    ----
+    The variance of `subgrid_anomaly(arr, z_coarse)` is the sum of the
+    spectrum over all levels larger than `z_coarse`.
+    """
+    z_in = hp.npix2order(arr.shape[-1])
+    if z_min >= z_in:
+        raise ValueError('Outuput zoom level needs to be smaller than input zoom level')
+    n_levels = z_in - z_min
+
+    packed = _decompose_blocks(arr, n_levels)
+    variance, anomalies, coarse = _unpack_decomposition(packed, arr.shape[-1], n_levels)
+    variance = np.moveaxis(variance, -1, 0) / np.array([hp.order2npix(z) for z in range(z_min + 1, z_in + 1)]).reshape(-1, *[1] * (arr.ndim - 1))
+    if not return_anomalies:
+        return variance
+    dtype = _pyramid_dtype(arr.dtype)
+    anomalies = {z_in - level: anomaly.astype(dtype, copy=False) for level, anomaly in enumerate(anomalies)}
+    return variance, anomalies, coarse.astype(dtype, copy=False)
+
+
+def subgrid_variance_decomposition_xr(da: xr.DataArray, z_min: int=0, gridn=None, return_anomalies: bool=False):
+    """Dask-native xarray wrapper for `subgrid_variance_decomposition`.
+
+    For dask arrays each chunk (aligned to whole cells of level `z_min`) is
+    decomposed on its own and only the sums of squares are combined over
+    chunks, so that the spectrum of every time step is computed in parallel
+    with one read of the data. The anomalies are lazy slices of the same
+    chunk results.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Data on the full nested healpix grid.
+    z_min : int, optional, by default 0
+    gridn : string, optional, by default None
+        String specifying the name of the grid variable. If None, try to guess it from frequent options
+    return_anomalies : bool, optional, by default False
+
+    Returns
+    -------
+    xr.DataArray
+        Variance spectrum with the new dimension 'zoom' in front of the non-spatial dimensions.
+    dict of xr.DataArray, only if return_anomalies is True
+        Local anomalies by zoom level on the grid of that level.
+    xr.DataArray, only if return_anomalies is True
+        Mean at zoom level `z_min`.
+    """
+    if gridn is None:  # try to guess grid name from frequent options
+        gridn = guess_gridn(da)
+
+    da = da.transpose(..., gridn)
+    dims = list(da.dims)
+    z_in = hp.npix2order(da[gridn].size)
+    zooms = list(range(z_min + 1, z_in + 1))
+    coords = {key: value for key, value in da.coords.items() if gridn not in value.dims}
+
+    if da.chunks is None:
+        result = subgrid_variance_decomposition(da.values, z_min, return_anomalies=return_anomalies)
+        variance, anomalies, coarse = result if return_anomalies else (result, None, None)
+    else:
+        import dask.array as dsa
+
+        if z_min >= z_in:
+            raise ValueError('Outuput zoom level needs to be smaller than input zoom level')
+        n_levels = z_in - z_min
+        data = _align_grid_chunks(dsa.asarray(da.data), 4**n_levels)
+        packed = dsa.map_blocks(
+            _decompose_blocks, data, n_levels,
+            chunks=(*data.chunks[:-1], tuple(_packed_size(c, n_levels) for c in data.chunks[-1])),
+            dtype=np.float64,
         )
-    return xr.apply_ufunc(
-        subgrid_anomaly,
-        da_fine,
-        input_core_dims=[[gridn]],
-        output_core_dims=[[gridn]],
-        vectorize=True,
-        kwargs={'z_coarse': z_coarse},
+        sumsq = _slice_packed(packed, data.chunks[-1], n_levels, 'sumsq')
+        variance = dsa.moveaxis(sumsq.reshape(*sumsq.shape[:-1], -1, n_levels).sum(axis=-2)[..., ::-1], -1, 0)
+        variance = variance / np.array([hp.order2npix(z) for z in zooms]).reshape(-1, *[1] * (data.ndim - 1))
+        if return_anomalies:
+            dtype = _pyramid_dtype(data.dtype)
+            anomalies = {z_in - level: _slice_packed(packed, data.chunks[-1], n_levels, level).astype(dtype) for level in range(n_levels)}
+            coarse = _slice_packed(packed, data.chunks[-1], n_levels, 'coarse').astype(dtype)
+
+    da_variance = xr.DataArray(variance, dims=['zoom', *dims[:-1]], coords={**coords, 'zoom': zooms}, name=da.name)
+    if not return_anomalies:
+        return da_variance
+    anomalies = {zoom: xr.DataArray(anomalies[zoom], dims=dims, coords=coords, name=da.name, attrs=da.attrs) for zoom in sorted(anomalies)}
+    return da_variance, anomalies, xr.DataArray(coarse, dims=dims, coords=coords, name=da.name, attrs=da.attrs)
+
+
+def _decompose_blocks(arr: np.ndarray, n_levels: int) -> np.ndarray:
+    """Local anomalies of `n_levels` successively coarser levels along the last axis.
+
+    Returns, packed along the last axis, the anomalies from the finest to the
+    coarsest level, the mean of the coarsest level and the sum of squares of
+    the anomalies of each level (see `_unpack_decomposition`).
+    """
+    mean = arr.astype(np.float64)
+    anomalies, sumsq = [], []
+    for _ in range(n_levels):
+        blocks = mean.reshape(*mean.shape[:-1], -1, 4)
+        mean = blocks.mean(axis=-1)
+        anomaly = (blocks - mean[..., None]).reshape(*mean.shape[:-1], -1)
+        anomalies.append(anomaly)
+        sumsq.append((anomaly**2).sum(axis=-1, keepdims=True))
+    return np.concatenate(anomalies + [mean] + sumsq, axis=-1)
+
+
+def _packed_size(npix: int, n_levels: int) -> int:
+    """Length of the output of `_decompose_blocks` for `npix` input cells."""
+    return sum(npix // 4**level for level in range(n_levels + 1)) + n_levels
+
+
+def _packed_slices(npix: int, n_levels: int) -> dict:
+    """Positions of the anomalies (by level), the coarse mean and the sums of squares in a packed block."""
+    slices, start = {}, 0
+    for level in range(n_levels):
+        slices[level] = slice(start, start + npix // 4**level)
+        start += npix // 4**level
+    slices['coarse'] = slice(start, start + npix // 4**n_levels)
+    slices['sumsq'] = slice(start + npix // 4**n_levels, start + npix // 4**n_levels + n_levels)
+    return slices
+
+
+def _unpack_decomposition(packed: np.ndarray, npix: int, n_levels: int):
+    """Split the output of `_decompose_blocks` into the sums of squares, anomalies and coarse mean."""
+    slices = _packed_slices(npix, n_levels)
+    anomalies = [packed[..., slices[level]] for level in range(n_levels)]
+    return packed[..., slices['sumsq']][..., ::-1], anomalies, packed[..., slices['coarse']]
+
+
+def _slice_packed(packed, npix_chunks, n_levels: int, key):
+    """Lazily select one part of each packed dask chunk, see `_packed_slices`."""
+    import dask.array as dsa
+
+    sizes = tuple(len(range(_packed_size(c, n_levels))[_packed_slices(c, n_levels)[key]]) for c in npix_chunks)
+    return dsa.map_blocks(
+        lambda block: block[..., _packed_slices(_npix_from_packed(block.shape[-1], n_levels), n_levels)[key]],
+        packed,
+        chunks=(*packed.chunks[:-1], sizes),
+        dtype=packed.dtype,
     )
 
+
+def _npix_from_packed(size: int, n_levels: int) -> int:
+    """Inverse of `_packed_size`."""
+    return (size - n_levels) * 4**n_levels // sum(4**level for level in range(n_levels + 1))
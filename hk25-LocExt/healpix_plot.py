@@ -9,16 +9,35 @@ Authors:
 
 """
 
+import itertools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import xarray as xr
 import healpy as hp
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-import easygems.healpix as egh
 import cartopy.feature as cfeature
 from matplotlib import patches
 
+# Cache of the healpix cells of map pixels, see `get_resample_index`
+RESAMPLE_INDEX_CACHE_SIZE = 16
+_RESAMPLE_INDEX_CACHE = {}
+
+VIDEO_SUFFIXES = ('.mp4', '.gif', '.webm', '.mov')
+
+# Number of sample points per map axis to estimate the pixel size, see `get_lod_zoom`
+LOD_SAMPLES = 128
+
+# Nested cells are loaded in blocks of this size in the regional mode, see `healpix_resample`
+REGIONAL_BLOCK_SIZE = 4**6
+
 
 def get_listed_colormap(levels, cmap='viridis', extend='neither', white=None, return_colors=False):
     """
@@ -127,6 +146,8 @@ def hp_plot(
     extend='neither',
     add_gridlines=False,
     dpi=72, 
+    lod=False,
+    regional=False,
     proj_kwargs={},
     cbar_kwargs={}, 
     rivers_lakes_kwargs={},
@@ -141,6 +162,7 @@ def hp_plot(
     ----------
     data : np.ndarray, shape (N,)
         Needs to be on a healpix grid, i.e., N needs to be divisibel by 12 * (2**zoom)**2
+        Can also be a dict of such arrays on several zoom levels (e.g., from `build_zoom_pyramid`).
     cmap : string, optional, by default 'viridis'
     ax : string or cartopy.ccrs, optional, by default 'Mollweide'
         Possible string values:
@@ -162,6 +184,15 @@ def hp_plot(
     dpi : int, optional, by default 150
         Plot resolution. NOTE: sometimes artifacts apear around the zero meridian, changing
         the resoltion might solve this. 
+    lod : bool, optional, by default False
+        Level of detail: average the data (and topography) to the coarsest zoom
+        level that still has at least one cell per pixel of the map (see
+        `get_lod_zoom`) before resampling. If `data` is a dict of zoom levels,
+        the coarsest suitable level is picked.
+    regional : bool, optional, by default False
+        Only load and resample the cells within the extent of the map (see
+        `healpix_resample`). With lazy inputs (e.g., from zarr) only the chunks
+        of the region are read. Useful together with `ax.set_extent`.
     proj_kwargs : dict, optional
         Keyword arguments passed on to ccrs.<Projection>. Only relevent if ax is a string
         specifying a projection. The allowed values depend on the projection:
@@ -236,6 +267,11 @@ def hp_plot(
             **defaults
         )
 
+    lod_zoom = get_lod_zoom(ax) if lod else None
+    data = _pick_lod(data, lod_zoom)
+    if topography is not None:
+        topography = _pick_lod(topography, lod_zoom)
+
     if topography is not None:
         defaults = dict(
             colors='gray',
@@ -247,13 +283,16 @@ def hp_plot(
         _, _, nx, ny = np.array(ax.bbox.bounds, dtype=int)
         xlims = ax.get_xlim()
         ylims = ax.get_ylim() 
-        im = egh.healpix_resample(
+        im = healpix_resample(
             topography, 
             xlims, ylims, 
             nx, ny, 
             ax.projection, 
             method='linear', 
-            nest=True)
+            nest=True,
+            regional=regional,
+            zoom=lod_zoom,
+        )
         
         map_ = ax.contour(
             im, 
@@ -293,13 +332,15 @@ def hp_plot(
     xlims = ax.get_xlim()
     ylims = ax.get_ylim()
 
-    im = egh.healpix_resample(
+    im = healpix_resample(
         data, 
         xlims, ylims, 
         nx, ny, 
         ax.projection, 
         method='nearest', 
         nest=True,
+        regional=regional,
+        zoom=lod_zoom,
     )
    
     map_ = ax.imshow(
@@ -320,6 +361,407 @@ def hp_plot(
     return fig, ax, map_
 
 
+def get_lod_zoom(ax, xlims=None, ylims=None, nx=None, ny=None) -> int:
+    """Get the coarsest zoom level with at least one healpix cell per pixel of the map.
+
+    The solid angle of the map pixels is estimated on a grid of LOD_SAMPLES
+    points per axis and the median is used. Global maps in projections that
+    are not equal-area (e.g. PlateCarree) therefore do not follow the small
+    pixels near the poles, where several map pixels share one cell.
+
+    Parameters
+    ----------
+    ax : cartopy.mpl.geoaxes.GeoAxes
+    xlims, ylims, nx, ny : optional
+        Limits and number of pixels of the map. By default taken from `ax`.
+
+    Returns
+    -------
+    int
+    """
+    _, _, nx_ax, ny_ax = np.array(ax.bbox.bounds, dtype=int)
+    xlims = ax.get_xlim() if xlims is None else xlims
+    ylims = ax.get_ylim() if ylims is None else ylims
+    nx = nx_ax if nx is None else nx
+    ny = ny_ax if ny is None else ny
+
+    xvals = np.linspace(xlims[0], xlims[1], min(nx, LOD_SAMPLES) + 1)
+    yvals = np.linspace(ylims[0], ylims[1], min(ny, LOD_SAMPLES) + 1)
+    xvals2, yvals2 = np.meshgrid(xvals, yvals)
+    lonlat = np.deg2rad(ccrs.PlateCarree().transform_points(ax.projection, xvals2, yvals2, np.zeros_like(xvals2)))
+    lon, lat = lonlat[..., 0], lonlat[..., 1]
+    vec = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    # solid angle of the quads between the sample points from the cross product of their edges
+    area = np.linalg.norm(np.cross(vec[1:, :-1] - vec[:-1, :-1], vec[:-1, 1:] - vec[:-1, :-1]), axis=-1)
+    area = area[np.isfinite(area) & (area > 0)]
+    if area.size == 0:
+        raise ValueError('The map does not show any part of the globe')
+    pixel_area = np.median(area) * (len(xvals) - 1) * (len(yvals) - 1) / (nx * ny)
+
+    # cell area 4 pi / (12 * 4**zoom) needs to be at most the pixel area
+    return max(0, int(np.ceil(np.log(4 * np.pi / (12 * pixel_area)) / np.log(4))))
+
+
+def select_lod(data, zoom=None):
+    """Select or compute the data on a zoom level for plotting.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (N,) or dict of np.ndarray
+        Data on one healpix grid or on several zoom levels (keyed by zoom).
+    zoom : int, optional, by default None
+        Target zoom level. If None, the data are returned on the finest level.
+
+    Returns
+    -------
+    np.ndarray, shape (M <= N,)
+        From a dict the coarsest level not coarser than `zoom` is picked. Data
+        on finer levels are averaged over nested blocks (ignoring NaN values).
+    """
+    data = _pick_lod(data, zoom)
+    if zoom is None:
+        return data
+    data = np.asarray(data)
+    return _coarsen_blocks(data, max(1, data.size // hp.order2npix(zoom)))
+
+
+def _pick_lod(data, zoom=None):
+    """Pick the coarsest level not coarser than `zoom` from data on several zoom levels."""
+    if not isinstance(data, dict):
+        return data
+    zooms = sorted(data)
+    return data[zooms[-1] if zoom is None else min([z for z in zooms if z >= zoom], default=zooms[-1])]
+
+
+def _coarsen_blocks(data: np.ndarray, ratio: int) -> np.ndarray:
+    """Average consecutive blocks of `ratio` nested cells, ignoring NaN values."""
+    if ratio <= 1:
+        return data
+    blocks = data.reshape(-1, ratio)
+    is_valid = ~np.isnan(blocks)
+    with np.errstate(invalid='ignore'):
+        return np.where(is_valid, blocks, 0).sum(axis=-1) / is_valid.sum(axis=-1)
+
+
+def _get_image_grid(ax, map_, lod):
+    """Get the limits, number of pixels and level of detail of an image drawn by `hp_plot`."""
+    ny, nx = map_.get_array().shape
+    extent = map_.get_extent()
+    xlims, ylims = tuple(extent[:2]), tuple(extent[2:])
+    lod_zoom = get_lod_zoom(ax, xlims, ylims, nx, ny) if lod else None
+    return xlims, ylims, nx, ny, lod_zoom
+
+
+def healpix_resample(var, xlims, ylims, nx, ny, src_crs, method='nearest', nest=True, regional=False, zoom=None):
+    """Resample healpix data to the pixels of a map.
+
+    Same result as `easygems.healpix.healpix_resample` but the transformation
+    from map pixels to healpix cells is cached (see `get_resample_index`), so
+    that resampling further fields onto the same map is a single gather.
+
+    Parameters
+    ----------
+    var : np.ndarray, shape (N,)
+    xlims, ylims : tuple
+        Limits of the map in projection coordinates (`ax.get_xlim()`, `ax.get_ylim()`)
+    nx, ny : int
+        Number of pixels of the map
+    src_crs : cartopy.crs.Projection
+        Projection of the map
+    method : string, optional, one of {'nearest', 'linear'}, by default 'nearest'
+    nest : bool, optional, by default True
+    regional : bool, optional, by default False
+        Only load the ranges of nested cells that are needed for the map
+        (`var[start:stop]`, see `get_resample_index`) instead of the full array.
+    zoom : int, optional, by default None
+        Average `var` to this zoom level first (if it is on a finer grid), see `select_lod`.
+
+    Returns
+    -------
+    np.ndarray, shape (ny, nx)
+    """
+    npix = np.shape(var)[-1]
+    nside = hp.npix2nside(npix) if zoom is None else min(hp.npix2nside(npix), 2**zoom)
+    ratio = npix // hp.nside2npix(nside)
+    if regional:
+        valid, pix, weights, ranges = get_resample_index(xlims, ylims, nx, ny, src_crs, nside, method, nest, regional=True)
+        var = _load_ranges(var, ranges * ratio)
+    else:
+        valid, pix, weights = get_resample_index(xlims, ylims, nx, ny, src_crs, nside, method, nest)
+        var = np.asarray(var)
+    var = _coarsen_blocks(var, ratio)
+    res = np.full(valid.shape, np.nan, dtype=var.dtype)
+    if method == 'nearest':
+        res[valid] = var[pix]
+    else:
+        res[valid] = np.sum(var[pix] * weights, axis=0)
+    return res
+
+
+def get_resample_index(xlims, ylims, nx, ny, src_crs, nside, method='nearest', nest=True, regional=False):
+    """Get the (cached) healpix cells of the centers of the map pixels.
+
+    Returns
+    -------
+    valid : np.ndarray of bool, shape (ny, nx)
+        Map pixels on the globe
+    pix : np.ndarray, shape (M,) for 'nearest' or (4, M) for 'linear'
+        Healpix cells of the M valid map pixels
+    weights : np.ndarray, shape (4, M) or None
+        Interpolation weights for 'linear'
+    ranges : np.ndarray, shape (R, 2), only if regional is True
+        Start and stop of the ranges of nested cells that contain all cells
+        needed for the map. `pix` then indexes the concatenation of these ranges.
+    """
+    key = (tuple(xlims), tuple(ylims), int(nx), int(ny), src_crs, int(nside), method, nest, regional)
+    if key not in _RESAMPLE_INDEX_CACHE:
+        if len(_RESAMPLE_INDEX_CACHE) >= RESAMPLE_INDEX_CACHE_SIZE:  # drop the oldest index
+            _RESAMPLE_INDEX_CACHE.pop(next(iter(_RESAMPLE_INDEX_CACHE)))
+        _RESAMPLE_INDEX_CACHE[key] = _compute_resample_index(*key)
+    return _RESAMPLE_INDEX_CACHE[key]
+
+
+def _compute_resample_index(xlims, ylims, nx, ny, src_crs, nside, method, nest, regional=False):
+    """Uncached implementation of `get_resample_index`."""
+    # NOTE: we want the center coordinate of each pixel, thus we have to
+    # compute the linspace over half a pixel size less than the plot's limits
+    dx = (xlims[1] - xlims[0]) / nx
+    dy = (ylims[1] - ylims[0]) / ny
+    xvals = np.linspace(xlims[0] + dx / 2, xlims[1] - dx / 2, nx)
+    yvals = np.linspace(ylims[0] + dy / 2, ylims[1] - dy / 2, ny)
+    xvals2, yvals2 = np.meshgrid(xvals, yvals)
+    latlon = ccrs.PlateCarree().transform_points(src_crs, xvals2, yvals2, np.zeros_like(xvals2))
+    valid = np.all(np.isfinite(latlon), axis=-1)
+    points = latlon[valid].T
+
+    weights = None
+    if method == 'nearest':
+        pix = hp.ang2pix(nside, theta=points[0], phi=points[1], nest=nest, lonlat=True)
+    elif method == 'linear':
+        pix, weights = hp.get_interp_weights(nside, theta=points[0], phi=points[1], nest=nest, lonlat=True)
+        weights.flags.writeable = False
+    else:
+        raise ValueError(f"interpolation method '{method}' not known")
+    if regional:
+        if not nest:
+            raise ValueError('The regional mode requires nested ordering')
+        pix, ranges = _get_cell_ranges(pix, nside)
+    valid.flags.writeable = False
+    pix.flags.writeable = False
+    if regional:
+        return valid, pix, weights, ranges
+    return valid, pix, weights
+
+
+def _get_cell_ranges(pix: np.ndarray, nside: int):
+    """Cover nested healpix cells with ranges of whole blocks of REGIONAL_BLOCK_SIZE cells.
+
+    In nested ordering the cells of a region form few long runs of
+    consecutive blocks, which are merged into ranges. Returns the positions of
+    `pix` in the concatenation of the ranges and the ranges.
+    """
+    block_size = min(REGIONAL_BLOCK_SIZE, hp.nside2npix(nside) // 12)
+    blocks = np.unique(pix // block_size)
+    is_first = np.diff(blocks, prepend=-2) != 1
+    is_last = np.diff(blocks, append=blocks[-1] + 2) != 1
+    ranges = np.stack([blocks[is_first], blocks[is_last] + 1], axis=-1) * block_size
+    offsets = np.cumsum(ranges[:, 1] - ranges[:, 0]) - (ranges[:, 1] - ranges[:, 0])
+    idx = np.searchsorted(ranges[:, 0], pix, side='right') - 1
+    return offsets[idx] + pix - ranges[idx, 0], ranges
+
+
+def _load_ranges(var, ranges: np.ndarray) -> np.ndarray:
+    """Load the ranges of cells `var[start:stop]` of a (lazy) array into one array."""
+    parts = [var[start:stop] for start, stop in ranges]
+    if isinstance(var, xr.DataArray):
+        return np.asarray(xr.concat(parts, dim=var.dims[-1]))
+    if getattr(var, 'chunks', None) is not None and hasattr(var, 'compute'):  # dask array
+        import dask.array as dsa
+        return np.asarray(dsa.concatenate(parts))
+    return np.concatenate([np.asarray(part) for part in parts])
+
+
+def hp_plot_frames(frames, filenames, titles=None, savefig_kwargs={}, **kwargs):
+    """Render a sequence of healpix fields to image files reusing one figure.
+
+    The first frame is drawn with `hp_plot` (including all static layers like
+    coastlines and colorbar). For all further frames only the image data are
+    replaced, using the cached resample index.
+
+    Parameters
+    ----------
+    frames : iterable of np.ndarray, shape (N,)
+        E.g., a xr.DataArray with dimensions (time, cell)
+    filenames : iterable of str
+        One output file per frame
+    titles : iterable of str, optional, by default None
+        One title per frame
+    savefig_kwargs : dict, optional
+        Keyword arguments passed on to `fig.savefig`
+    **kwargs : optional
+        Keyword arguments passed on to `hp_plot`. Topography contours are only drawn once.
+
+    Returns
+    -------
+    fig, ax, map_: tuple
+    """
+    titles = itertools.repeat(None) if titles is None else titles
+    fig = ax = map_ = None
+    for frame, filename, title in zip(frames, filenames, titles):
+        if map_ is None:
+            fig, ax, map_ = hp_plot(frame, **kwargs)
+            xlims, ylims, nx, ny, lod_zoom = _get_image_grid(ax, map_, kwargs.get('lod', False))
+        else:
+            frame = _pick_lod(frame, lod_zoom)
+            map_.set_data(healpix_resample(
+                frame, xlims, ylims, nx, ny, ax.projection, method='nearest', nest=True,
+                regional=kwargs.get('regional', False), zoom=lod_zoom,
+            ))
+        if title is not None:
+            ax.set_title(title)
+        fig.savefig(filename, **savefig_kwargs)
+    return fig, ax, map_
+
+
+def hp_plot_animation(frames, output, titles=None, fps=10, max_workers=None, savefig_kwargs={}, **kwargs):
+    """Render a sequence of healpix fields in parallel to PNG files or a video.
+
+    The frames are split into contiguous parts, which are rendered by
+    `hp_plot_frames` in a pool of processes. Each process draws the static
+    layers (coastlines, rivers, topography, colorbar) and creates the
+    colormap once. The resample index of the map is computed once here and
+    saved to temporary .npy files, which all processes memory-map instead of
+    receiving a copy (at 300 dpi it can take more than 1 GB). Without `levels`, `vmin`/`vmax` or `norm`, the
+    colour limits of the first frame are used for all frames (as in
+    `hp_plot_frames`).
+
+    Parameters
+    ----------
+    frames : np.ndarray or xr.DataArray, shape (T, N)
+        Lazy (dask) arrays are loaded frame by frame in the processes.
+    output : str
+        Directory for the PNG files 'frame_00000.png', ... or, if it ends with
+        one of VIDEO_SUFFIXES, the video file (written with ffmpeg).
+    titles : list of str, optional, by default None
+        One title per frame
+    fps : int, optional, by default 10
+        Frames per second of the video
+    max_workers : int, optional, by default None
+        Number of processes. Defaults to the number of processors.
+    savefig_kwargs : dict, optional
+        Keyword arguments passed on to `fig.savefig`
+    **kwargs : optional
+        Keyword arguments passed on to `hp_plot`. `ax` needs to be a string.
+
+    Returns
+    -------
+    list of str or str
+        The PNG files or the video file.
+    """
+    if not isinstance(kwargs.get('ax', ''), str):
+        raise ValueError('ax needs to be the name of a projection to create the figures in other processes')
+
+    if os.path.splitext(output)[1] in VIDEO_SUFFIXES:
+        # fail before rendering all frames if the video cannot be written
+        ffmpeg = _get_ffmpeg()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hp_plot_animation(frames, tmp_dir, titles, fps, max_workers, savefig_kwargs, **kwargs)
+            _write_video(ffmpeg, os.path.join(tmp_dir, 'frame_%05d.png'), output, fps)
+        return output
+
+    os.makedirs(output, exist_ok=True)
+    n_frames = len(frames)
+    filenames = [os.path.join(output, f'frame_{idx:05d}.png') for idx in range(n_frames)]
+    titles = [None] * n_frames if titles is None else list(titles)
+
+    # compute the resample index once (without drawing) to share it with all processes
+    fig, ax, map_ = hp_plot(frames[0], **{**kwargs, 'topography': None})
+    xlims, ylims, nx, ny, lod_zoom = _get_image_grid(ax, map_, kwargs.get('lod', False))
+    resample_index = {}
+    for method, var in [('nearest', frames[0]), ('linear', kwargs.get('topography'))]:
+        if var is not None:
+            nside = hp.npix2nside(np.shape(var)[-1])
+            nside = nside if lod_zoom is None else min(nside, 2**lod_zoom)
+            key = (xlims, ylims, nx, ny, ax.projection, nside, method, True, kwargs.get('regional', False))
+            resample_index[key] = get_resample_index(*key)
+    if kwargs.get('levels') is None and 'norm' not in kwargs:
+        # use the same colour limits in all processes instead of autoscaling each part
+        vmin, vmax = map_.get_clim()
+        kwargs = {'vmin': vmin, 'vmax': vmax, **kwargs}
+    plt.close(fig)
+
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    n_parts = max(1, min(max_workers, n_frames))
+    parts = np.array_split(np.arange(n_frames), n_parts)
+    with tempfile.TemporaryDirectory() as index_dir, ProcessPoolExecutor(
+        max_workers=n_parts,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_render_process,
+        initargs=(_save_resample_index(resample_index, index_dir),),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _render_frames,
+                frames[idxs[0]:idxs[-1] + 1],
+                filenames[idxs[0]:idxs[-1] + 1],
+                titles[idxs[0]:idxs[-1] + 1],
+                savefig_kwargs,
+                kwargs,
+            )
+            for idxs in parts
+        ]
+        for future in futures:
+            future.result()
+    return filenames
+
+
+def _save_resample_index(resample_index, index_dir):
+    """Save the arrays of resample indices to .npy files and return their paths by key."""
+    paths = {}
+    for idx, (key, arrays) in enumerate(resample_index.items()):
+        paths[key] = []
+        for jdx, array in enumerate(arrays):
+            if array is None:
+                paths[key].append(None)
+                continue
+            path = os.path.join(index_dir, f'index_{idx}_{jdx}.npy')
+            np.save(path, array)
+            paths[key].append(path)
+    return paths
+
+
+def _init_render_process(resample_index_paths):
+    """Use a non-interactive backend and fill the resample index cache with memory-mapped arrays in a render process."""
+    mpl.use('Agg')
+    for key, paths in resample_index_paths.items():
+        _RESAMPLE_INDEX_CACHE[key] = tuple(None if path is None else np.load(path, mmap_mode='r') for path in paths)
+
+
+def _render_frames(frames, filenames, titles, savefig_kwargs, kwargs):
+    """Render a contiguous part of the frames in one process."""
+    fig, _, _ = hp_plot_frames(frames, filenames, titles, savefig_kwargs, **kwargs)
+    plt.close(fig)
+    return filenames
+
+
+def _get_ffmpeg():
+    """Get the path of the ffmpeg executable set in the matplotlib rcParams."""
+    ffmpeg = shutil.which(mpl.rcParams['animation.ffmpeg_path'])
+    if ffmpeg is None:
+        raise FileNotFoundError('ffmpeg is required to write videos, use a directory as output to get PNG files')
+    return ffmpeg
+
+
+def _write_video(ffmpeg, pattern, output, fps):
+    """Combine numbered PNG files into a video with ffmpeg."""
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-framerate', str(fps), '-i', pattern]
+    if not output.endswith('.gif'):
+        # most video codecs require even image sizes
+        cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+    subprocess.run(cmd + [output], check=True)
+
+
 def plot_polygon(ax, corners, closed=True, **kwargs):
     """
     Plot a user-defined polygon on the map.
@@ -1,4 +1,5 @@
 import healpy as hp  
+from functools import lru_cache
 from scipy.interpolate import NearestNDInterpolator 
 import numpy as np
 import xarray as xr
@@ -45,13 +46,29 @@ def attach_coords(ds, nside, nest_tf):
     Returns:
         xarray.Dataset: Dataset with added 'lat' and 'lon' coordinates
     """
-    lons, lats = hp.pix2ang(nside, ds.cell.values, nest=nest_tf, lonlat=True)
+    lons, lats = _lonlat_table(nside, bool(nest_tf))
+    lons, lats = lons[ds.cell.values], lats[ds.cell.values]
     return ds.assign_coords(
         lat=(("cell",), lats, {"units": "degrees_north"}),
         lon=(("cell",), lons, {"units": "degrees_east"}),
     )
 
 
+@lru_cache(maxsize=None)
+def _lonlat_table(nside, nest_tf):
+    """
+    Longitude and latitude of every Healpix cell, computed once per nside and ordering.
+
+    Parameters:
+        nside (int): Healpix resolution
+        nest_tf (bool): Whether Healpix indexing is nested
+
+    Returns:
+        tuple of numpy arrays: longitudes and latitudes of all 12 * nside**2 cells
+    """
+    return hp.pix2ang(nside, np.arange(hp.nside2npix(nside)), nest=nest_tf, lonlat=True)
+
+
 def interpolate_field_lon_lat(field, lon_coord="lon", lat_coord="lat", relative_resolution=2):
     """
     Interpolates a 1D spatial field to a regular 2D lon-lat grid using nearest-neighbor.
@@ -89,7 +106,21 @@ def nest2ring_index(ds, nside):
         ds (xarray:Dataset): dataset with cell as dimensions
         nside (int): nside of the zoom level 
     """
-    return np.array([hp.ring2nest(nside, i) for i in ds.cell.values])
+    return _nest2ring_table(nside)[ds.cell.values]
+
+
+@lru_cache(maxsize=None)
+def _nest2ring_table(nside):
+    """
+    Nested index of every ring cell, computed once per nside for the full map.
+
+    Parameters:
+        nside (int): nside of the zoom level
+
+    Returns:
+        numpy array: int64 array of length 12 * nside**2
+    """
+    return hp.ring2nest(nside, np.arange(hp.nside2npix(nside), dtype=np.int64))
 
 def compute_hder(var, nside):
         """